@@ -10,7 +10,10 @@
 '''
 from datetime import datetime; start = datetime.now()
 from logging import getLogger, FileHandler, StreamHandler, Formatter, DEBUG, INFO
-import gc, os, random, re
+import gc, json, mmap, os, random, re
+from collections import Counter
+from itertools import repeat
+from multiprocessing import Pool
 from time import time; start_time = time()
 
 import numpy as np
@@ -18,15 +21,13 @@ import pandas as pd
 from sklearn import metrics
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from tqdm import tqdm
-
-from keras.preprocessing.text import Tokenizer
-from keras.preprocessing.sequence import pad_sequences
 
 import torch
 from torch import nn, optim
 from torch.nn import functional as F
-from torch.utils.data import TensorDataset, DataLoader, Dataset
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.dataloader import default_collate
 
 
 # parameters
@@ -37,13 +38,23 @@ emb_size = 300
 max_features = 120000
 maxlen = 70
 embedding_trainable = False
+emb_dtype = 'float32'  # frozen embedding storage: 'float32', 'float16' or 'int8'
 n_capsule = 5
 capsule_dim = 5
+routings_eval = None  # capsule routing iterations at inference, None: as many as in training
+rnn = 'lstm'  # recurrent block: 'lstm' (LSTM then GRU) or 'sru'
+packed = False  # run the LSTM/GRU on packed sequences, the padding skips the recurrence (the head masks it either way)
+model_name = 'rnn_capsule'  # 'rnn_capsule' or 'text_cnn'
+kernel_sizes = [1, 2, 3, 5]  # TextCNN convolution widths
+n_filters = 64  # TextCNN filters per width
 # data
 test_size = 0.1
 random_state = 2018
 batch_size = 512
 batch_size_val = 4096
+feature_names = ['capitals/length', 'words/uniques']
+n_jobs = os.cpu_count()
+emb_store_dir = 'emb_store'  # generated, kept out of the read-only ../input
 # training
 device = 'cuda:0'
 thresholds = np.arange(0.3, 0.501, 0.01)
@@ -91,6 +102,59 @@ logger.addHandler(fh)
 logger.addHandler(sh)
 
 
+class QuantizedEmbedding(nn.Module):
+    '''
+    Frozen nn.Embedding stored as float16 or int8 with a per-row scale.
+    Only the looked-up rows are dequantized to float32 in forward.
+    unfreeze() swaps in a float32 weight so training goes on as with nn.Embedding.
+    '''
+
+    def __init__(self, embedding, dtype='float16'):
+        super(QuantizedEmbedding, self).__init__()
+        embedding = torch.as_tensor(embedding, dtype=torch.float32)
+        self.dtype = dtype
+        if dtype == 'float16':
+            self.register_buffer('weight_q', embedding.half())
+            self.register_buffer('scale', None)
+        elif dtype == 'int8':
+            scale = embedding.abs().max(dim=1, keepdim=True)[0].clamp(min=1e-8) / 127.
+            self.register_buffer('weight_q', torch.round(embedding / scale).to(torch.int8))
+            self.register_buffer('scale', scale)
+        else:
+            raise NotImplementedError('No dtype: {}'.format(dtype))
+        self.register_parameter('weight', None)
+
+    def dequantize(self, x):
+        h = self.weight_q[x].float()
+        if self.scale is not None:
+            h = h * self.scale[x]
+        return h
+
+    def unfreeze(self):
+        if self.weight is None:
+            self.weight = nn.Parameter(self.dequantize(torch.arange(len(self.weight_q), device=self.weight_q.device)))
+            self.weight_q, self.scale = None, None
+
+    def forward(self, x):
+        if self.weight is not None:
+            return F.embedding(x, self.weight)
+        return self.dequantize(x)
+
+
+def make_embedding(vocab_size, embedding_dim, embedding=None, trainable=False, dtype='float32'):
+    '''
+    nn.Embedding initialised from embedding and frozen unless trainable,
+    or a QuantizedEmbedding for a frozen embedding stored as float16/int8 (unfreeze(model) swaps it back)
+    '''
+    if embedding is not None and dtype != 'float32' and not trainable:
+        return QuantizedEmbedding(embedding, dtype)
+    layer = nn.Embedding(vocab_size, embedding_dim)
+    if embedding is not None:
+        layer.weight = nn.Parameter(torch.tensor(embedding, dtype=torch.float32))
+        layer.weight.requires_grad = trainable
+    return layer
+
+
 class Attention(nn.Module):
     def __init__(self, hidden_size, step_size, bias=True, **kwargs):
         super(Attention, self).__init__()
@@ -103,24 +167,52 @@ class Attention(nn.Module):
         self.weight = nn.Parameter(weight)
         self.bias = nn.Parameter(torch.zeros(step_size)) if bias else None
 
-    def forward(self, x, mask=None):
-        eij = torch.mm(x.contiguous().view(-1, self.hidden_size), self.weight).view(-1, self.step_size)
+    def attention_weights(self, x, mask=None):
+        # batches can be trimmed to fewer steps than step_size, left padding aligns them on the last bias terms
+        step_size = x.size(1)
+        eij = torch.mm(x.contiguous().view(-1, self.hidden_size), self.weight).view(-1, step_size)
         if self.bias is not None:
-            eij += self.bias
+            eij += self.bias[self.step_size - step_size:]
         eij = torch.tanh(eij)
         a = torch.exp(eij)
-        if mask is not None:
-            a = a * mask
-        a = a / torch.sum(a, dim=1, keepdim=True) + 1e-10
+        if mask is None:
+            return a / torch.sum(a, dim=1, keepdim=True) + 1e-10
+        # the same arithmetic as without mask, so a row without padding gets the same weights bit for bit,
+        # and padding gets exactly zero weight
+        a = a.masked_fill(~mask, 0)
+        return (a / torch.sum(a, dim=1, keepdim=True) + 1e-10).masked_fill(~mask, 0)
+
+    def forward(self, x, mask=None):
+        a = self.attention_weights(x, mask)
         weighted = x * torch.unsqueeze(a, -1)
         return torch.sum(weighted, dim=1)
 
 
+class AttentionPooling(Attention):
+    '''
+    Attention, mean and max pooling of the same hidden states in one head, returns the three of them.
+    Without mask it computes exactly what Attention, torch.mean and torch.max did.
+    With mask, padding is left out of all three with the same arithmetic,
+    so a batch without padding gives bit-identical outputs either way.
+    '''
+
+    def forward(self, x, mask=None):
+        if mask is None:
+            return super(AttentionPooling, self).forward(x), torch.mean(x, 1), torch.max(x, 1)[0]
+        attn_pool = super(AttentionPooling, self).forward(x, mask)
+        mask_weights = mask.unsqueeze(-1).to(x.dtype)
+        # torch.mean of the masked states rescaled by steps / lengths, the scale is exactly 1 on full rows
+        avg_pool = torch.mean(x * mask_weights, 1) * (x.size(1) / mask_weights.sum(1))
+        max_pool = x.masked_fill(~mask.unsqueeze(-1), float('-inf')).max(1)[0]
+        return attn_pool, avg_pool, max_pool
+
+
 class Capsule(nn.Module):
     def __init__(
         self, input_dim_capsule=64 * 2,
         num_capsule=n_capsule, dim_capsule=capsule_dim,
         routings=4, kernel_size=(9, 1), share_weights=True, activation='default',
+        input_num_capsule=maxlen, routings_eval=routings_eval,
         **kwargs
     ):
         super(Capsule, self).__init__(**kwargs)
@@ -129,6 +221,7 @@ class Capsule(nn.Module):
         self.num_capsule = num_capsule
         self.dim_capsule = dim_capsule
         self.routings = routings
+        self.routings_eval = routings_eval
         self.kernel_size = kernel_size
         self.share_weights = share_weights
         if activation == 'default':
@@ -141,35 +234,42 @@ class Capsule(nn.Module):
                 nn.init.xavier_normal_(
                     torch.empty(1, input_dim_capsule, self.num_capsule * self.dim_capsule)))
         else:
+            # one weight matrix per input capsule (step)
             self.W = nn.Parameter(
-                torch.randn(BATCH_SIZE, input_dim_capsule, self.num_capsule * self.dim_capsule))
-
-    def forward(self, x):
+                nn.init.xavier_normal_(
+                    torch.empty(input_num_capsule, input_dim_capsule, self.num_capsule * self.dim_capsule)))
+
+    def forward(self, x, mask=None, routings=None):
+        '''
+        Dynamic routing with u_hat_vecs kept as (batch_size, num_capsule, input_num_capsule, dim_capsule)
+        and the logits b as (batch_size, num_capsule, 1, input_num_capsule),
+        so both steps of an iteration are batched matmuls and the softmax runs over num_capsule in place.
+        routings: iterations for this call, by default routings in training and routings_eval (if set) in eval
+        '''
+        if mask is not None:
+            x = x * mask.unsqueeze(-1).to(x.dtype)
+        batch_size = x.size(0)
+        input_num_capsule = x.size(1)
         if self.share_weights:
             u_hat_vecs = torch.matmul(x, self.W)
         else:
-            print('add later')
-
-        batch_size = x.size(0)
-        input_num_capsule = x.size(1)
+            # left padding aligns batches trimmed to fewer steps on the last weights
+            W = self.W[len(self.W) - input_num_capsule:]
+            u_hat_vecs = torch.bmm(x.transpose(0, 1), W).transpose(0, 1)
         u_hat_vecs = u_hat_vecs.view(
             (batch_size, input_num_capsule, self.num_capsule, self.dim_capsule))
-        u_hat_vecs = u_hat_vecs.permute(0, 2, 1, 3)
-        # (batch_size,num_capsule,input_num_capsule)
-        b = torch.zeros_like(u_hat_vecs[:, :, :, 0])
-
-        for i in range(self.routings):
-            b = b.permute(0, 2, 1)
-            c = F.softmax(b, dim=2)
-            c = c.permute(0, 2, 1)
-            b = b.permute(0, 2, 1)
-            # batch matrix multiplication
-            outputs = self.activation(torch.einsum('bij,bijk->bik', (c, u_hat_vecs)))
-            # outputs shape (batch_size, num_capsule, dim_capsule)
-            if i < self.routings - 1:
-                b = torch.einsum('bik,bijk->bij', (outputs, u_hat_vecs))
-                # batch matrix multiplication
-        return outputs  # (batch_size, num_capsule, dim_capsule)
+        u_hat_vecs = u_hat_vecs.permute(0, 2, 1, 3).contiguous()
+        if routings is None:
+            routings = self.routings if self.training or self.routings_eval is None else self.routings_eval
+
+        b = u_hat_vecs.new_zeros(batch_size, self.num_capsule, 1, input_num_capsule)
+        for i in range(routings):
+            c = F.softmax(b, dim=1)
+            outputs = self.activation(torch.matmul(c, u_hat_vecs))
+            # outputs shape (batch_size, num_capsule, 1, dim_capsule)
+            if i < routings - 1:
+                b = torch.matmul(outputs, u_hat_vecs.transpose(2, 3))
+        return outputs.squeeze(2)  # (batch_size, num_capsule, dim_capsule)
 
     def squash(self, x, axis=-1):
         '''# text version of squash, slight different from original one.'''
@@ -178,27 +278,155 @@ class Capsule(nn.Module):
         return x / scale
 
 
+def padding_mask(x):
+    '''(mask, lengths) of the left-padded ids x, an all-padding row keeps its last step so that no sequence is empty'''
+    lengths = (x != 0).sum(1).clamp(min=1)
+    mask = torch.arange(x.size(1), device=x.device) >= (x.size(1) - lengths).unsqueeze(1)
+    return mask, lengths
+
+
+def realign(h, lengths, restore=False):
+    '''
+    Rotate the tokens of each row of the left-padded h to the front (right-padded, as packing expects),
+    restore: rotate the tokens of a right-padded h back to the end
+    '''
+    steps = torch.arange(h.size(1), device=h.device)
+    shift = (h.size(1) - lengths).unsqueeze(1)
+    index = (steps - shift if restore else steps + shift) % h.size(1)
+    return h.gather(1, index.unsqueeze(-1).expand(-1, -1, h.size(2)))
+
+
+def pack(h, lengths):
+    return pack_padded_sequence(realign(h, lengths), lengths.cpu(), batch_first=True, enforce_sorted=False)
+
+
+def unpack(h, lengths, total_length):
+    h, _ = pad_packed_sequence(h, batch_first=True, total_length=total_length)
+    return realign(h, lengths, restore=True)
+
+
+class SRURecurrence(torch.autograd.Function):
+    '''
+    c_t = f_t * c_(t-1) + u_t over the steps of (batch, steps, directions * hidden) u and f, from c0.
+    The hidden units of the second direction run from the last step to the first.
+    Both loops write into preallocated time-major buffers, and the backward loop is written out
+    so that autograd does not record a node per step.
+    '''
+
+    @staticmethod
+    def forward(ctx, u, f, c0, num_directions):
+        batch, seq, size = u.shape
+        hidden = size // num_directions
+        cs = u.new_empty(seq, batch, size)
+        for direction in range(num_directions):
+            d = slice(direction * hidden, (direction + 1) * hidden)
+            c = c0[:, d]
+            for t in (range(seq - 1, -1, -1) if direction == 1 else range(seq)):
+                c = torch.addcmul(u[:, t, d], f[:, t, d], c, out=cs[t, :, d])
+        ctx.save_for_backward(f, c0, cs)
+        ctx.num_directions = num_directions
+        return cs.transpose(0, 1)
+
+    @staticmethod
+    def backward(ctx, grad_cs):
+        f, c0, cs = ctx.saved_tensors
+        seq, batch, size = cs.shape
+        hidden = size // ctx.num_directions
+        grad_cs = grad_cs.transpose(0, 1)
+        grad_u, grad_f, grad_c0 = torch.empty_like(cs), torch.empty_like(cs), torch.empty_like(c0)
+        for direction in range(ctx.num_directions):
+            d = slice(direction * hidden, (direction + 1) * hidden)
+            g = c0.new_zeros(batch, hidden)
+            first, previous = (seq - 1, 1) if direction == 1 else (0, -1)
+            for t in (range(seq) if direction == 1 else range(seq - 1, -1, -1)):
+                g = torch.add(g, grad_cs[t, :, d], out=grad_u[t, :, d])
+                torch.mul(g, c0[:, d] if t == first else cs[t + previous, :, d], out=grad_f[t, :, d])
+                g = g * f[:, t, d]
+            grad_c0[:, d] = g
+        return grad_u.transpose(0, 1), grad_f.transpose(0, 1), grad_c0, None
+
+
+class SRU(nn.Module):
+    '''
+    Simple Recurrent Unit (Lei et al. 2017), a drop-in for nn.LSTM/nn.GRU with batch_first=True.
+    One matmul covers all the steps and directions, only c_t = f_t * c_(t-1) + (1 - f_t) * x~_t
+    is left to loop over the steps (SRURecurrence), and h_t = r_t * tanh(c_t) + (1 - r_t) * x_t
+    is elementwise again, x_t goes through a skip projection when its size differs from the output's.
+    Takes a PackedSequence as nn.LSTM does, the padding carries the state through unchanged so the backward
+    direction starts from hx at the last token of every sequence.
+    Returns (output, c_n)
+    '''
+
+    def __init__(
+        self, input_size, hidden_size, num_layers=1, bias=True, batch_first=True, dropout=0., bidirectional=False
+    ):
+        super(SRU, self).__init__()
+        assert batch_first
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.num_directions = 2 if bidirectional else 1
+        self.dropout = nn.Dropout(dropout)
+        self.layers = nn.ModuleList()
+        size = hidden_size * self.num_directions
+        for layer_i in range(num_layers):
+            layer_input_size = input_size if layer_i == 0 else size
+            # x~, forget gate, reset gate and the skip projection of x if needed, each for all directions
+            n_projections = 3 if layer_input_size == size else 4
+            self.layers.append(nn.Linear(layer_input_size, n_projections * size, bias=bias))
+
+    def forward(self, x, hx=None):
+        is_packed = isinstance(x, nn.utils.rnn.PackedSequence)
+        if is_packed:
+            x, lengths = pad_packed_sequence(x, batch_first=True)
+            padding = (torch.arange(x.size(1)) >= lengths.unsqueeze(1)).to(x.device).unsqueeze(-1)
+        bs = x.size(0)
+        size = self.hidden_size * self.num_directions
+        if hx is None:
+            hx = x.new_zeros(self.num_layers * self.num_directions, bs, self.hidden_size)
+        c_n = []
+        for layer_i, linear in enumerate(self.layers):
+            if layer_i > 0:
+                x = self.dropout(x)
+            projections = linear(x)
+            if projections.size(2) > 3 * size:
+                x_tilde, gates, skip = projections.split([size, 2 * size, size], 2)
+            else:
+                (x_tilde, gates), skip = projections.split([size, 2 * size], 2), x
+            f, r = torch.sigmoid(gates).chunk(2, 2)
+            u = torch.addcmul(x_tilde, f, x_tilde, value=-1)
+            if is_packed:
+                f, u = f.masked_fill(padding, 1), u.masked_fill(padding, 0)
+            c0 = hx[layer_i * self.num_directions:(layer_i + 1) * self.num_directions].transpose(0, 1).reshape(bs, -1)
+            cs = SRURecurrence.apply(u, f, c0, self.num_directions)
+            last = cs[torch.arange(bs), lengths.to(x.device) - 1] if is_packed else cs[:, -1]
+            c_n += [last[:, :self.hidden_size], cs[:, 0, self.hidden_size:]][:self.num_directions]
+            x = torch.addcmul(skip, r, torch.tanh(cs) - skip)
+        if is_packed:
+            x = pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        return x, torch.stack(c_n)
+
+
 class RNN(nn.Module):
 
     def __init__(
         self, vocab_size, embedding_dim=300, embedding=None, embedding_trainable=False,
-        hidden_dim=64, n_layers=1, device='cuda:0'
+        embedding_dtype='float32', hidden_dim=64, n_layers=1, rnn='lstm', packed=False, device='cuda:0'
     ):
         super(RNN, self).__init__()
         self.hidden_dim = hidden_dim
         self.n_layers = n_layers
+        self.rnn = rnn
+        self.packed = packed
         self.device = device
 
-        self.embedding = nn.Embedding(vocab_size, embedding_dim)
-        if embedding is not None:
-            self.embedding.weight = nn.Parameter(torch.tensor(embedding, dtype=torch.float32))
-            self.embedding.weight.requires_grad = embedding_trainable
+        self.embedding = make_embedding(vocab_size, embedding_dim, embedding, embedding_trainable, embedding_dtype)
         # TODO: SpatialDropout1D
         self.dropout1 = nn.Dropout(0.5)
-        self.lstm = nn.LSTM(
+        lstm, gru = (nn.LSTM, nn.GRU) if rnn == 'lstm' else (SRU, SRU)
+        self.lstm = lstm(
             embedding_dim, hidden_dim, num_layers=n_layers, bias=False, batch_first=True, dropout=0.,
             bidirectional=True)
-        self.gru = nn.GRU(
+        self.gru = gru(
             hidden_dim * 2, hidden_dim, num_layers=n_layers, bias=False, batch_first=True, dropout=0.,
             bidirectional=True)
         # self.attn_gru = Attention(hidden_dim * 2, maxlen)
@@ -212,11 +440,22 @@ class RNN(nn.Module):
         bs = x.size(0)
         h0 = torch.zeros(self.n_layers * 2, bs, self.hidden_dim).to(self.device)
         c0 = torch.zeros(self.n_layers * 2, bs, self.hidden_dim).to(self.device)
+        # SRU keeps a single state
+        state = (h0, c0) if self.rnn == 'lstm' else h0
+
+        seq = x.size(1)
+        mask, lengths = padding_mask(x) if self.packed else (None, None)
 
         x = self.embedding(x)
         x = self.dropout1(x)
-        x, (h, c) = self.lstm(x, (h0, c0))
-        x, hidden = self.gru(x, h)
+        if self.packed:
+            x, h = self.lstm(pack(x, lengths), state)
+            x, hidden = self.gru(x, h[0] if self.rnn == 'lstm' else h)
+            # last step of the forward direction is the last token of every row once the steps are realigned
+            x = unpack(x, lengths, seq)
+        else:
+            x, h = self.lstm(x, state)
+            x, hidden = self.gru(x, h[0] if self.rnn == 'lstm' else h)
         # x = self.attn_gru(x)
         x = x[:, -1, :]
         x = x.view(bs, -1)
@@ -229,24 +468,23 @@ class RNN(nn.Module):
 class RNNCapsule(nn.Module):
     def __init__(
         self, vocab_size, embedding_dim=300, embedding=None, embedding_trainable=False,
-        hidden_size=64, n_layers=1, device='cuda:0'
+        embedding_dtype='float32', hidden_size=64, n_layers=1, rnn='lstm', packed=False, device='cuda:0'
     ):
         super(RNNCapsule, self).__init__()
 
-        n_features = 2
+        n_features = len(feature_names)
+        self.packed = packed
 
-        self.embedding = nn.Embedding(vocab_size, embedding_dim)
-        if embedding is not None:
-            self.embedding.weight = nn.Parameter(torch.tensor(embedding, dtype=torch.float32))
-            self.embedding.weight.requires_grad = embedding_trainable
+        self.embedding = make_embedding(vocab_size, embedding_dim, embedding, embedding_trainable, embedding_dtype)
         self.dropout_emb = nn.Dropout2d(0.1)
 
-        self.lstm = nn.LSTM(embedding_dim, hidden_size, bidirectional=True, batch_first=True)
-        self.gru = nn.GRU(hidden_size * 2, hidden_size, bidirectional=True, batch_first=True)
+        lstm, gru = (nn.LSTM, nn.GRU) if rnn == 'lstm' else (SRU, SRU)
+        self.lstm = lstm(embedding_dim, hidden_size, bidirectional=True, batch_first=True)
+        self.gru = gru(hidden_size * 2, hidden_size, bidirectional=True, batch_first=True)
         self.lstm2 = nn.LSTM(hidden_size * 2, hidden_size, bidirectional=True, batch_first=True)
 
         self.attn_lstm = Attention(hidden_size * 2, maxlen)
-        self.attn_gru = Attention(hidden_size * 2, maxlen)
+        self.attn_gru = AttentionPooling(hidden_size * 2, maxlen)
 
         self.bn = nn.BatchNorm1d(16, momentum=0.5)
         self.fc1 = nn.Linear(hidden_size * 8 + 1 + n_features, 16)
@@ -260,22 +498,27 @@ class RNNCapsule(nn.Module):
 
     def forward(self, x):
         x, features = x[0], x[1]
+        seq = x.size(1)
+        # padding is masked out of the capsule, attention and pooling packed or not, even in batches without any
+        mask, lengths = padding_mask(x)
         h = self.embedding(x)
         h = self.dropout_emb(h)
-        h_lstm, _ = self.lstm(h)
-        h_gru, _ = self.gru(h_lstm)
+        if self.packed:
+            h_lstm, _ = self.lstm(pack(h, lengths))
+            h_gru, _ = self.gru(h_lstm)
+            h_lstm, h_gru = unpack(h_lstm, lengths, seq), unpack(h_gru, lengths, seq)
+        else:
+            h_lstm, _ = self.lstm(h)
+            h_gru, _ = self.gru(h_lstm)
         # capsule layer
-        content3 = self.capsule(h_gru)
+        content3 = self.capsule(h_gru, mask)
         content3 = self.dropout(content3)
         batch_size = content3.size(0)
         content3 = content3.view(batch_size, -1)
         content3 = self.relu(self.linear_capsule(content3))
         # attention
-        attn_lstm = self.attn_lstm(h_lstm)
-        attn_gru = self.attn_gru(h_gru)
-
-        avg_pool = torch.mean(h_gru, 1)
-        max_pool, _ = torch.max(h_gru, 1)
+        attn_lstm = self.attn_lstm(h_lstm, mask)
+        attn_gru, avg_pool, max_pool = self.attn_gru(h_gru, mask)
 
         out = torch.cat(
             [attn_lstm, attn_gru, content3, avg_pool, max_pool, features],
@@ -286,6 +529,67 @@ class RNNCapsule(nn.Module):
         return out.squeeze()
 
 
+class TextCNN(nn.Module):
+    '''
+    Convolutions of several widths over the embedded tokens, max-over-time pooled (Kim 2014),
+    concatenated with the features. Every step is computed at once, no recurrence.
+    Only the last max(kernel_sizes) - 1 padding steps of a batch are convolved and the windows
+    that see padding only are zeroed before the pooling, so a row scores the same in any batch.
+    '''
+
+    def __init__(
+        self, vocab_size, embedding_dim=300, embedding=None, embedding_trainable=False,
+        embedding_dtype='float32', kernel_sizes=(1, 2, 3, 5), n_filters=64, device='cuda:0'
+    ):
+        super(TextCNN, self).__init__()
+
+        n_features = len(feature_names)
+
+        self.embedding = make_embedding(vocab_size, embedding_dim, embedding, embedding_trainable, embedding_dtype)
+        self.dropout_emb = nn.Dropout2d(0.1)
+
+        self.kernel_sizes = kernel_sizes
+        self.convs = nn.ModuleList([nn.Conv1d(embedding_dim, n_filters, k) for k in kernel_sizes])
+
+        self.bn = nn.BatchNorm1d(16, momentum=0.5)
+        self.fc1 = nn.Linear(n_filters * len(kernel_sizes) + n_features, 16)
+        self.relu = nn.ReLU()
+        self.dropout = nn.Dropout(0.1)
+        self.out = nn.Linear(16, 1)
+        self.sigmoid = nn.Sigmoid()
+
+    def forward(self, x):
+        x, features = x[0], x[1]
+        _, lengths = padding_mask(x)
+        seq = min(x.size(1), int(lengths.max()) + max(self.kernel_sizes) - 1)
+        x = x[:, -seq:]
+        h = self.embedding(x)
+        h = self.dropout_emb(h)
+        # (batch, emb, steps) for Conv1d
+        h = h.transpose(1, 2)
+        pools = []
+        for k, conv in zip(self.kernel_sizes, self.convs):
+            # window t covers the steps t..t+k-1, it sees padding only if it ends before the first token
+            padding_only = torch.arange(k - 1, seq, device=x.device) < (seq - lengths).unsqueeze(1)
+            out = self.relu(conv(h)).masked_fill(padding_only.unsqueeze(1), 0)
+            pools.append(out.max(2)[0])
+
+        out = torch.cat(pools + [features], 1)
+        out = self.dropout(out)
+        out = self.relu(self.bn(self.fc1(out)))
+        out = self.out(out)
+        out = self.sigmoid(out)
+        return out.squeeze()
+
+
+def unfreeze(model):
+    for module in model.modules():
+        if isinstance(module, QuantizedEmbedding):
+            module.unfreeze()
+    for param in model.parameters():
+        param.requires_grad = True
+
+
 class EarlyStopping(object):
     '''
     cf. https://gist.github.com/stefanonardo/693d96ceb2f531fa05db530f3e21517d
@@ -428,56 +732,209 @@ def test(model, data_loader, device):
     return np.array(outputs).flatten()
 
 
-def get_coefs(word, *arr):
-    return word, np.asarray(arr, dtype='float32')
+def _file_identity(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
 
 
-def get_embedding(path, word_index, name='glove'):
-    if name.lower() == 'glove':
-        embeddings_index = dict(get_coefs(*o.split(' '))[:300] for o in open(path))
-    elif name.lower() == 'fasttext':
-        embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(path) if len(o) > 100)
-    elif name.lower() == 'paragram':
-        embeddings_index = dict(
-            get_coefs(*o.split(" "))
-            for o in open(path, encoding="utf8", errors='ignore') if len(o) > 100)
-    elif name.lower() == 'google':
-        loaded = KeyedVectors.load_word2vec_format(path, binary=True)
-        embeddings_index = dict([(k, loaded[k]) for k in loaded.vocab.keys()])
+def _block_stats(values):
+    '''(count, mean, M2) of a block of values'''
+    mean = values.mean(dtype='float64')
+    return values.size, mean, ((values - mean) ** 2).sum(dtype='float64')
+
+
+def _merge_stats(a, b):
+    '''
+    Combine two (count, mean, M2) of Welford's algorithm
+    cf. https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    '''
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def load_emb_stats(path, name, store_dir=emb_store_dir):
+    '''emb_mean/emb_std saved next to the embedding, None if missing or stale'''
+    stats_path = os.path.join(store_dir, name, 'stats.json')
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path) as f:
+        stats = json.load(f)
+    return stats if stats['source'] == _file_identity(path) else None
+
+
+def save_emb_stats(path, name, stats, store_dir=emb_store_dir):
+    count, mean, m2 = stats
+    stats = {'count': int(count), 'mean': float(mean), 'std': float(np.sqrt(m2 / count)),
+             'source': _file_identity(path)}
+    os.makedirs(os.path.join(store_dir, name), exist_ok=True)
+    with open(os.path.join(store_dir, name, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+    logger.info('Embedding stats {}: mean {:.6f} std {:.6f}'.format(name, stats['mean'], stats['std']))
+    return stats
+
+
+def parse_emb_text(path, word_index, shape, stats=None):
+    '''
+    One streaming pass over a text embedding file, only the vectors of word_index are kept.
+    Without stats (emb_mean/emb_std) they are accumulated in the same pass, block by block.
+    Returns (embedding_matrix, (count, mean, M2) or None)
+    '''
+    t0 = time()
+    vocab = {word: i for word, i in word_index.items() if i < max_features}
+    found, block, new_stats = {}, [], (0, 0., 0.)
+    with open(path, encoding='utf8', errors='ignore') as f:
+        for o in f:
+            values = o.rstrip().rsplit(' ', emb_size)
+            if len(values) != emb_size + 1: continue  # noqa: header or broken line
+            i = vocab.get(values[0])
+            if i is None and stats is not None:
+                continue
+            vector = np.asarray(values[1:], dtype='float32')
+            if i is not None:
+                found[i] = vector  # the last occurrence wins, as when the vectors were read into a dict
+            if stats is None:
+                block.append(vector)
+                if len(block) == 4096:
+                    new_stats = _merge_stats(new_stats, _block_stats(np.stack(block)))
+                    block = []
+    if stats is None:
+        if block:
+            new_stats = _merge_stats(new_stats, _block_stats(np.stack(block)))
+        count, emb_mean, m2 = new_stats
+        emb_std = np.sqrt(m2 / count)
+    else:
+        emb_mean, emb_std = stats['mean'], stats['std']
+    embedding_matrix = np.random.normal(emb_mean, emb_std, shape)
+    for i, vector in found.items():
+        embedding_matrix[i] = vector
+    logger.info('Parsed {} ({}/{} words) in {:.2f}s'.format(
+        os.path.basename(path), len(found), len(vocab), time() - t0))
+    return embedding_matrix, None if stats is not None else new_stats
+
+
+def read_word2vec_bin(path, word_index, shape, stats=None):
+    '''
+    Dependency-free reader for the word2vec .bin format (GoogleNews):
+    a `n_words dim` header line, then `word<space>` + dim little-endian float32 per word.
+    The file is memory-mapped, one scan builds the word -> offset index
+    and only the rows of word_index are converted.
+    Returns (embedding_matrix, (count, mean, M2) or None)
+    '''
+    t0 = time()
+    vocab = {word: i for word, i in word_index.items() if i < max_features}
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_end = mm.find(b'\n') + 1
+    n_words, dim = map(int, mm[:header_end].split())
+    assert dim == shape[1], 'emb_size {} != {}'.format(shape[1], dim)
+    offsets = np.empty(n_words, dtype='int64')
+    found = {}
+    pos = header_end
+    for r in range(n_words):
+        end = mm.find(b' ', pos)
+        offsets[r] = end + 1
+        i = vocab.get(mm[pos:end].lstrip(b'\n').decode('utf-8', 'ignore'))
+        if i is not None:
+            found[i] = end + 1  # the last occurrence wins
+        pos = end + 1 + 4 * dim
+
+    data = np.frombuffer(mm, dtype=np.uint8)
+    columns = np.arange(4 * dim)
+    new_stats = None
+    if stats is None:
+        new_stats = (0, 0., 0.)
+        for a in range(0, n_words, 4096):
+            block = data[offsets[a:a + 4096, None] + columns].view('<f4')
+            new_stats = _merge_stats(new_stats, _block_stats(block))
+        count, emb_mean, m2 = new_stats
+        emb_std = np.sqrt(m2 / count)
     else:
+        emb_mean, emb_std = stats['mean'], stats['std']
+    embedding_matrix = np.random.normal(emb_mean, emb_std, shape)
+    indices = np.fromiter(found.keys(), dtype='int64', count=len(found))
+    rows = np.fromiter(found.values(), dtype='int64', count=len(found))
+    for a in range(0, len(rows), 4096):
+        embedding_matrix[indices[a:a + 4096]] = data[rows[a:a + 4096, None] + columns].view('<f4')
+    del data
+    mm.close()
+    logger.info('Read {} ({}/{} words) in {:.2f}s'.format(
+        os.path.basename(path), len(found), len(vocab), time() - t0))
+    return embedding_matrix, new_stats
+
+
+def get_embedding(path, word_index, name='glove'):
+    if name.lower() not in ('glove', 'fasttext', 'paragram', 'google'):
         raise NotImplementedError('No embedding: {}'.format(name))
-    logger.info('Created embedding_index.')
-
-    all_embs = np.stack(embeddings_index.values())
-    emb_mean, emb_std = all_embs.mean(), all_embs.std()
-    emb_size = all_embs.shape[1]
-    n_words = min(max_features, len(word_index))
-    logger.info('Creating embedding_matrix')
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (n_words, emb_size))
-    for word, i in tqdm(word_index.items()):
-        if i >= max_features:
-            continue
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None:
-            embedding_matrix[i] = embedding_vector
-    #     else:
-    #         embedding_vector = embeddings_index.get(word.capitalize())
-    #         if embedding_vector is not None:
-    #             embedding_matrix[i] = embedding_vector
-    del embeddings_index, all_embs, embedding_vector
+    shape = (min(max_features, len(word_index)), emb_size)
+    parse = read_word2vec_bin if name.lower() == 'google' else parse_emb_text
+    embedding_matrix, new_stats = parse(path, word_index, shape, load_emb_stats(path, name))
+    if new_stats is not None:
+        save_emb_stats(path, name, new_stats)
     gc.collect()
     return embedding_matrix
 
 
-def preprocess_contraction(text, mapping):
+class MultiReplacer(object):
+    '''
+    Replace the keys of a mapping in one left-to-right pass, compiled once.
+    The keys are put in a trie that is compiled into a single regex. At each position the match is
+    the first key in mapping order, as with re.compile('|'.join(mapping.keys())).
+    whole_tokens: only replace keys that are whole space-separated tokens
+    '''
+
+    def __init__(self, mapping, whole_tokens=False):
+        self.mapping = mapping
+        trie = {}
+        for key in mapping:
+            node = trie
+            for ch in key:
+                if '' in node and not whole_tokens:
+                    break  # an earlier key is a prefix of this one and always matches first
+                node = node.setdefault(ch, {})
+            else:
+                node[''] = True
+        pattern = self._trie_pattern(trie)
+        if whole_tokens:
+            pattern = '(?<![^ ]){}(?![^ ])'.format(pattern)
+        self.regex = re.compile(pattern)
+
+    @classmethod
+    def _trie_pattern(cls, node):
+        branches = [re.escape(ch) + cls._trie_pattern(child) for ch, child in node.items() if ch != '']
+        if not branches:
+            return ''
+        if '' in node:
+            branches.append('')  # the key ending here comes after the longer, earlier keys
+        elif len(branches) == 1:
+            return branches[0]
+        return '(?:{})'.format('|'.join(branches))
+
+    def replace(self, match):
+        return self.mapping[match.group(0)]
+
+    def __call__(self, text):
+        return self.regex.sub(self.replace, text)
+
+
+contraction_replacer = MultiReplacer(contraction_mapping, whole_tokens=True)
+misspell_replacer = MultiReplacer(misspell_dict)
+
+
+def preprocess_contraction(text, mapping=contraction_mapping):
     '''
     https://www.kaggle.com/theoviel/improve-your-score-with-text-preprocessing-v2
+    mapping replaces whole space-separated tokens in one pass, contraction_mapping through the
+    precompiled contraction_replacer, any other mapping is compiled for the call
     '''
     specials = ["’", "‘", "´", "`"]
     for s in specials:
         text = text.replace(s, "'")
-    text = ' '.join([mapping[t] if t in mapping else t for t in text.split(" ")])
-    return text
+    replacer = contraction_replacer if mapping is contraction_mapping else MultiReplacer(mapping, whole_tokens=True)
+    return replacer(text)
 
 
 def preprocess_punctuation(text, punctuation, mapping):
@@ -495,68 +952,379 @@ def preprocess_punctuation(text, punctuation, mapping):
     return text
 
 
-def clean_punctuation(x):
-    puncts = [',', '.', '"', ':', ')', '(', '-', '!', '?', '|', ';', "'", '$', '&', '/', '[', ']', '>', '%', '=', '#', '*', '+', '\\', '•',  '~', '@', '£',
+puncts = [',', '.', '"', ':', ')', '(', '-', '!', '?', '|', ';', "'", '$', '&', '/', '[', ']', '>', '%', '=', '#', '*', '+', '\\', '•',  '~', '@', '£',
  '·', '_', '{', '}', '©', '^', '®', '`',  '<', '→', '°', '€', '™', '›',  '♥', '←', '×', '§', '″', '′', 'Â', '█', '½', 'à', '…',
  '“', '★', '”', '–', '●', 'â', '►', '−', '¢', '²', '¬', '░', '¶', '↑', '±', '¿', '▾', '═', '¦', '║', '―', '¥', '▓', '—', '‹', '─',
  '▒', '：', '¼', '⊕', '▼', '▪', '†', '■', '’', '▀', '¨', '▄', '♫', '☆', 'é', '¯', '♦', '¤', '▲', 'è', '¸', '¾', 'Ã', '⋅', '‘', '∞',
  '∙', '）', '↓', '、', '│', '（', '»', '，', '♪', '╩', '╚', '³', '・', '╦', '╣', '╔', '╗', '▬', '❤', 'ï', 'Ø', '¹', '≤', '‡', '√', ]
-    x = str(x)
-    for punct in puncts:
-        x = x.replace(punct, f' {punct} ')
-    return x
+punct_table = str.maketrans({punct: f' {punct} ' for punct in puncts})
+
+
+def clean_punctuation(x):
+    '''Pads every punct with spaces in a single str.translate, every punct is one character'''
+    return str(x).translate(punct_table)
+
+
+number_re = re.compile('[0-9]{2,}')
+number_marks = ['', '', '##', '###', '####', '#####']
 
 
 def clean_number(x):
-    x = re.sub('[0-9]{5,}', '#####', x)
-    x = re.sub('[0-9]{4}', '####', x)
-    x = re.sub('[0-9]{3}', '###', x)
-    x = re.sub('[0-9]{2}', '##', x)
-    return x
+    '''Each run of 2-4 digits is masked with as many #, 5 or more with #####, in a single regex pass'''
+    return number_re.sub(lambda match: number_marks[min(len(match.group(0)), 5)], x)
 
 
-def preprocess_misspell(text, dictinary):
+def preprocess_misspell(text, dictinary=misspell_dict):
     '''
     https://www.kaggle.com/theoviel/improve-your-score-with-text-preprocessing-v2
+    One pass over the text instead of one str.replace per key, so a replacement is not rescanned by later keys,
+    misspell_dict through the precompiled misspell_replacer, any other dictinary is compiled for the call
     '''
-    for word in dictionary.keys():
-        text = text.replace(word, dictinary[word])
-    return text
+    replacer = misspell_replacer if dictinary is misspell_dict else MultiReplacer(dictinary)
+    return replacer(text)
 
 
-def _get_mispell(mispell_dict):
-    mispell_re = re.compile('(%s)' % '|'.join(mispell_dict.keys()))
-    return mispell_dict, mispell_re
+typical_mispell_dict = {"ain't": "is not", "aren't": "are not","can't": "cannot", "'cause": "because", "could've": "could have", "couldn't": "could not", "didn't": "did not",  "doesn't": "does not", "don't": "do not", "hadn't": "had not", "hasn't": "has not", "haven't": "have not", "he'd": "he would","he'll": "he will", "he's": "he is", "how'd": "how did", "how'd'y": "how do you", "how'll": "how will", "how's": "how is",  "I'd": "I would", "I'd've": "I would have", "I'll": "I will", "I'll've": "I will have","I'm": "I am", "I've": "I have", "i'd": "i would", "i'd've": "i would have", "i'll": "i will",  "i'll've": "i will have","i'm": "i am", "i've": "i have", "isn't": "is not", "it'd": "it would", "it'd've": "it would have", "it'll": "it will", "it'll've": "it will have","it's": "it is", "let's": "let us", "ma'am": "madam", "mayn't": "may not", "might've": "might have","mightn't": "might not","mightn't've": "might not have", "must've": "must have", "mustn't": "must not", "mustn't've": "must not have", "needn't": "need not", "needn't've": "need not have","o'clock": "of the clock", "oughtn't": "ought not", "oughtn't've": "ought not have", "shan't": "shall not", "sha'n't": "shall not", "shan't've": "shall not have", "she'd": "she would", "she'd've": "she would have", "she'll": "she will", "she'll've": "she will have", "she's": "she is", "should've": "should have", "shouldn't": "should not", "shouldn't've": "should not have", "so've": "so have","so's": "so as", "this's": "this is","that'd": "that would", "that'd've": "that would have", "that's": "that is", "there'd": "there would", "there'd've": "there would have", "there's": "there is", "here's": "here is","they'd": "they would", "they'd've": "they would have", "they'll": "they will", "they'll've": "they will have", "they're": "they are", "they've": "they have", "to've": "to have", "wasn't": "was not", "we'd": "we would", "we'd've": "we would have", "we'll": "we will", "we'll've": "we will have", "we're": "we are", "we've": "we have", "weren't": "were not", "what'll": "what will", "what'll've": "what will have", "what're": "what are",  "what's": "what is", "what've": "what have", "when's": "when is", "when've": "when have", "where'd": "where did", "where's": "where is", "where've": "where have", "who'll": "who will", "who'll've": "who will have", "who's": "who is", "who've": "who have", "why's": "why is", "why've": "why have", "will've": "will have", "won't": "will not", "won't've": "will not have", "would've": "would have", "wouldn't": "would not", "wouldn't've": "would not have", "y'all": "you all", "y'all'd": "you all would","y'all'd've": "you all would have","y'all're": "you all are","y'all've": "you all have","you'd": "you would", "you'd've": "you would have", "you'll": "you will", "you'll've": "you will have", "you're": "you are", "you've": "you have", 'colour': 'color', 'centre': 'center', 'favourite': 'favorite', 'travelling': 'traveling', 'counselling': 'counseling', 'theatre': 'theater', 'cancelled': 'canceled', 'labour': 'labor', 'organisation': 'organization', 'wwii': 'world war 2', 'citicise': 'criticize', 'youtu ': 'youtube ', 'Qoura': 'Quora', 'sallary': 'salary', 'Whta': 'What', 'narcisist': 'narcissist', 'howdo': 'how do', 'whatare': 'what are', 'howcan': 'how can', 'howmuch': 'how much', 'howmany': 'how many', 'whydo': 'why do', 'doI': 'do I', 'theBest': 'the best', 'howdoes': 'how does', 'mastrubation': 'masturbation', 'mastrubate': 'masturbate', "mastrubating": 'masturbating', 'pennis': 'penis', 'Etherium': 'Ethereum', 'narcissit': 'narcissist', 'bigdata': 'big data', '2k17': '2017', '2k18': '2018', 'qouta': 'quota', 'exboyfriend': 'ex boyfriend', 'airhostess': 'air hostess', "whst": 'what', 'watsapp': 'whatsapp', 'demonitisation': 'demonetization', 'demonitization': 'demonetization', 'demonetisation': 'demonetization'}
+typical_mispell_replacer = MultiReplacer(typical_mispell_dict)
 
 
 def replace_typical_misspell(text):
-    mispell_dict = {"ain't": "is not", "aren't": "are not","can't": "cannot", "'cause": "because", "could've": "could have", "couldn't": "could not", "didn't": "did not",  "doesn't": "does not", "don't": "do not", "hadn't": "had not", "hasn't": "has not", "haven't": "have not", "he'd": "he would","he'll": "he will", "he's": "he is", "how'd": "how did", "how'd'y": "how do you", "how'll": "how will", "how's": "how is",  "I'd": "I would", "I'd've": "I would have", "I'll": "I will", "I'll've": "I will have","I'm": "I am", "I've": "I have", "i'd": "i would", "i'd've": "i would have", "i'll": "i will",  "i'll've": "i will have","i'm": "i am", "i've": "i have", "isn't": "is not", "it'd": "it would", "it'd've": "it would have", "it'll": "it will", "it'll've": "it will have","it's": "it is", "let's": "let us", "ma'am": "madam", "mayn't": "may not", "might've": "might have","mightn't": "might not","mightn't've": "might not have", "must've": "must have", "mustn't": "must not", "mustn't've": "must not have", "needn't": "need not", "needn't've": "need not have","o'clock": "of the clock", "oughtn't": "ought not", "oughtn't've": "ought not have", "shan't": "shall not", "sha'n't": "shall not", "shan't've": "shall not have", "she'd": "she would", "she'd've": "she would have", "she'll": "she will", "she'll've": "she will have", "she's": "she is", "should've": "should have", "shouldn't": "should not", "shouldn't've": "should not have", "so've": "so have","so's": "so as", "this's": "this is","that'd": "that would", "that'd've": "that would have", "that's": "that is", "there'd": "there would", "there'd've": "there would have", "there's": "there is", "here's": "here is","they'd": "they would", "they'd've": "they would have", "they'll": "they will", "they'll've": "they will have", "they're": "they are", "they've": "they have", "to've": "to have", "wasn't": "was not", "we'd": "we would", "we'd've": "we would have", "we'll": "we will", "we'll've": "we will have", "we're": "we are", "we've": "we have", "weren't": "were not", "what'll": "what will", "what'll've": "what will have", "what're": "what are",  "what's": "what is", "what've": "what have", "when's": "when is", "when've": "when have", "where'd": "where did", "where's": "where is", "where've": "where have", "who'll": "who will", "who'll've": "who will have", "who's": "who is", "who've": "who have", "why's": "why is", "why've": "why have", "will've": "will have", "won't": "will not", "won't've": "will not have", "would've": "would have", "wouldn't": "would not", "wouldn't've": "would not have", "y'all": "you all", "y'all'd": "you all would","y'all'd've": "you all would have","y'all're": "you all are","y'all've": "you all have","you'd": "you would", "you'd've": "you would have", "you'll": "you will", "you'll've": "you will have", "you're": "you are", "you've": "you have", 'colour': 'color', 'centre': 'center', 'favourite': 'favorite', 'travelling': 'traveling', 'counselling': 'counseling', 'theatre': 'theater', 'cancelled': 'canceled', 'labour': 'labor', 'organisation': 'organization', 'wwii': 'world war 2', 'citicise': 'criticize', 'youtu ': 'youtube ', 'Qoura': 'Quora', 'sallary': 'salary', 'Whta': 'What', 'narcisist': 'narcissist', 'howdo': 'how do', 'whatare': 'what are', 'howcan': 'how can', 'howmuch': 'how much', 'howmany': 'how many', 'whydo': 'why do', 'doI': 'do I', 'theBest': 'the best', 'howdoes': 'how does', 'mastrubation': 'masturbation', 'mastrubate': 'masturbate', "mastrubating": 'masturbating', 'pennis': 'penis', 'Etherium': 'Ethereum', 'narcissit': 'narcissist', 'bigdata': 'big data', '2k17': '2017', '2k18': '2018', 'qouta': 'quota', 'exboyfriend': 'ex boyfriend', 'airhostess': 'air hostess', "whst": 'what', 'watsapp': 'whatsapp', 'demonitisation': 'demonetization', 'demonitization': 'demonetization', 'demonetisation': 'demonetization'}
-    mispellings, mispellings_re = _get_mispell(mispell_dict)
-    def replace(match):
-        return mispellings[match.group(0)]
-    return mispellings_re.sub(replace, text)
-
-
-def preprocess(df):
-    df['question_text'] = df['question_text'].apply(lambda x: x.lower())
-    df['question_text'] = df['question_text'].apply(lambda text: clean_punctuation(text))
-    df['question_text'] = df['question_text'].apply(lambda text: clean_number(text))
-    df['question_text'] = df['question_text'].apply(lambda text: replace_typical_misspell(text))
-    return df
+    return typical_mispell_replacer(text)
+
+
+punctuation_set = frozenset(punctuation)
+text_stat_names = ['length', 'n_capitals', 'n_words', 'n_unique_words', 'n_punctuation', 'n_digits', 'n_non_ascii']
+char_classes = [str.isupper, punctuation_set.__contains__, str.isdigit, str.isspace]
+
 
+def char_class_table(codes):
+    '''Bit i of table[code] is char_classes[i](chr(code)), evaluated only for the code points present'''
+    table = np.zeros(codes.max() + 1 if len(codes) else 1, dtype='uint8')
+    for code in np.flatnonzero(np.bincount(codes)):
+        c = chr(code)
+        table[code] = sum(1 << i for i, f in enumerate(char_classes) if f(c))
+    return table
 
-def add_features(df):
-    df['length'] = df['question_text'].apply(len)
-    df['n_capitals'] = df['question_text'].apply(
-        lambda text: sum(1 for c in text if c.isupper()))
-    df['capitals/length'] = df['n_capitals'] / df['length']
-    df['n_words'] = df['question_text'].str.count('\S+')
-    df['n_unique_words'] = df['question_text'].apply(
-        lambda text: len(set(text.split())))
-    df['words/uniques'] = df['n_words'] / df['n_unique_words']
+
+def _text_stats_shard(texts):
+    '''
+    Raw counts of text_stat_names for texts, vectorised over the concatenated code points:
+    each char is classified once through a lookup table and the counts are bincounts per text
+    '''
+    lengths = np.fromiter(map(len, texts), dtype='int64', count=len(texts))
+    starts = np.cumsum(lengths) - lengths
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype='uint32')
+    flags = char_class_table(codes)[codes]
+    space = (flags & 8).astype(bool)
+    after_space = np.ones(len(codes), dtype=bool)
+    after_space[1:] = space[:-1]
+    after_space[starts[lengths > 0]] = True
+    text_ids = np.repeat(np.arange(len(texts)), lengths)
+
+    def segment_count(mask):
+        return np.bincount(text_ids[mask], minlength=len(texts))
+
+    stats = np.empty((len(texts), len(text_stat_names)), dtype='float64')
+    stats[:, 0] = lengths
+    stats[:, 1] = segment_count((flags & 1).astype(bool))
+    stats[:, 2] = segment_count(~space & after_space)
+    stats[:, 3] = [len(set(text.split())) for text in texts]
+    stats[:, 4] = segment_count((flags & 2).astype(bool))
+    stats[:, 5] = segment_count((flags & 4).astype(bool))
+    stats[:, 6] = segment_count(codes > 127)
+    return stats
+
+
+preprocess_stages = [
+    ('lower', str.lower),
+    ('clean_punctuation', clean_punctuation),
+    ('clean_number', clean_number),
+    ('replace_typical_misspell', replace_typical_misspell),
+]
+
+
+def _preprocess_shard(texts):
+    timings = []
+    t0 = time()
+    stats = _text_stats_shard(texts)
+    timings.append(time() - t0)
+    for name, fn in preprocess_stages:
+        t0 = time()
+        texts = [fn(text) for text in texts]
+        timings.append(time() - t0)
+    return texts, stats, timings
+
+
+def preprocess_texts(texts, n_workers=None):
+    '''
+    Count the text stats of the raw texts (_text_stats_shard) and run the preprocess_stages chain,
+    sharded across a process pool. Each worker runs the whole chain on its shard, shards come back in order.
+    Returns (texts, stats)
+    '''
+    t0 = time()
+    n_workers = min(n_workers or n_jobs, max(len(texts) // 10000, 1))
+    n_shards = max(min(len(texts), n_workers * 4), 1)
+    bounds = np.linspace(0, len(texts), n_shards + 1).astype('int64')
+    shards = [texts[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            results = pool.map(_preprocess_shard, shards)
+    else:
+        results = [_preprocess_shard(shard) for shard in shards]
+    texts = [text for shard_texts, _, _ in results for text in shard_texts]
+    stats = np.vstack([shard_stats for _, shard_stats, _ in results])
+    # CPU time of each stage summed over the workers
+    timings = np.sum([shard_timings for _, _, shard_timings in results], axis=0)
+    stages = [('text_stats', None)] + preprocess_stages
+    logger.info('Preprocessed {} texts on {} workers in {:.2f}s: {}'.format(
+        len(texts), n_workers, time() - t0,
+        ', '.join('{} {:.2f}s'.format(name, t) for (name, _), t in zip(stages, timings))))
+    return texts, stats
+
+
+def add_features(df, stats):
+    '''
+    Columns of the raw text stats and the ratios derived from them on whole columns.
+    Divisions by zero give NaN/inf like the pandas version did, main() fills them
+    '''
+    for i, name in enumerate(text_stat_names):
+        df[name] = stats[:, i].astype('int64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['capitals/length'] = stats[:, 1] / stats[:, 0]
+        df['words/uniques'] = stats[:, 2] / stats[:, 3]
+        df['punctuation/length'] = stats[:, 4] / stats[:, 0]
+        df['digits/length'] = stats[:, 5] / stats[:, 0]
+        df['non_ascii/length'] = stats[:, 6] / stats[:, 0]
     return df
 
 
+def preprocess(df, n_workers=None):
+    '''Clean question_text and add the features of the raw text, in one pass of preprocess_texts'''
+    texts, stats = preprocess_texts(df['question_text'].tolist(), n_workers)
+    df['question_text'] = texts
+    return add_features(df, stats)
+
+
+def split_texts(texts, filter_table, lower=True, split=' '):
+    '''
+    The words of all texts from a single str.split of the texts joined by a marker char none of them contains.
+    Returns (words, marker), the empty strings left by repeated separators are kept for callers to drop.
+    '''
+    if lower:
+        texts = map(str.lower, texts)
+    if filter_table:
+        texts = (text.translate(filter_table) for text in texts)
+    texts = list(texts)
+    chars = ''.join(texts) + split
+    marker = next(c for c in map(chr, range(0x110000)) if c not in chars)
+    return (split + marker + split).join(texts).split(split), marker
+
+
+def _count_words(args):
+    texts, filter_table, lower, split = args
+    words, marker = split_texts(texts, filter_table, lower, split)
+    word_counts = Counter(words)
+    word_counts.pop('', None)
+    word_counts.pop(marker, None)
+    # the words of each text lie between two markers of the same split
+    word_docs = Counter()
+    start = 0
+    for _ in range(len(texts) - 1):
+        end = words.index(marker, start)
+        word_docs.update(set(words[start:end]))
+        start = end + 1
+    word_docs.update(set(words[start:]))
+    word_docs.pop('', None)
+    return len(texts), word_counts, word_docs
+
+
+class Tokenizer:
+    '''
+    Drop-in for keras.preprocessing.text.Tokenizer (word level) without importing keras.
+    Same word_index: words ranked by count, ties in order of first occurrence, oov_token forced to 1.
+    Same sequences: words with index >= num_words and unseen words are dropped, or become oov_token.
+    fit_on_texts counts shards on a process pool and merges them in order,
+    texts_to_sequences looks up all the words of all texts in one flat pass.
+    '''
+    def __init__(
+        self, num_words=None, filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n', lower=True,
+        split=' ', oov_token=None
+    ):
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.oov_token = oov_token
+        self.filter_table = str.maketrans({c: split for c in filters})
+        self.word_counts = Counter()
+        self.word_docs = Counter()
+        self.document_count = 0
+        self.word_index = {}
+        self.index_word = {}
+
+    def fit_on_texts(self, texts, n_workers=None, pool=None):
+        n_workers = pool._processes if pool is not None else n_workers or n_jobs
+        n_shards = max(min(len(texts) // 10000, n_workers * 4), 1)
+        bounds = np.linspace(0, len(texts), n_shards + 1).astype('int64')
+        shards = [(texts[a:b], self.filter_table, self.lower, self.split) for a, b in zip(bounds[:-1], bounds[1:])]
+        if pool is not None:
+            results = pool.map(_count_words, shards)
+        elif n_workers > 1 and n_shards > 1:
+            with Pool(n_workers) as pool:
+                results = pool.map(_count_words, shards)
+        else:
+            results = [_count_words(shard) for shard in shards]
+        # merging in shard order keeps the words in order of first occurrence for the tie-break
+        for document_count, word_counts, word_docs in results:
+            self.document_count += document_count
+            self.word_counts.update(word_counts)
+            self.word_docs.update(word_docs)
+        vocab = [] if self.oov_token is None else [self.oov_token]
+        vocab.extend(word for word, _ in sorted(self.word_counts.items(), key=lambda item: item[1], reverse=True))
+        self.word_index = {word: i for i, word in enumerate(vocab, 1)}
+        self.index_word = {i: word for word, i in self.word_index.items()}
+
+    def texts_to_ragged(self, texts):
+        '''Returns (flat int32 indices of all the texts, int64 lengths)'''
+        oov_index = self.word_index.get(self.oov_token, 0)
+        # word -> output index, 0 for the words keras drops, -1 between texts
+        lookup = {
+            word: i if not self.num_words or i < self.num_words else oov_index
+            for word, i in self.word_index.items()}
+        words, marker = split_texts(texts, self.filter_table, self.lower, self.split)
+        lookup[''] = 0
+        lookup[marker] = -1
+        ids = np.fromiter(map(lookup.get, words, repeat(oov_index)), dtype='int32', count=len(words))
+        text_ids = np.cumsum(ids == -1)
+        keep = ids > 0
+        return ids[keep], np.bincount(text_ids[keep], minlength=len(texts))
+
+    def texts_to_sequences(self, texts):
+        ids, lengths = self.texts_to_ragged(texts)
+        ids, ends = ids.tolist(), np.cumsum(lengths).tolist()
+        return [ids[a:b] for a, b in zip([0] + ends[:-1], ends)]
+
+
+def pad_ragged(ids, lengths, maxlen=None, padding='pre', truncating='pre', value=0, out=None):
+    '''
+    Write the flat ids of consecutive sequences into a (len(lengths), maxlen) int32 matrix with one boolean mask assignment.
+    padding/truncating follow keras' pad_sequences: 'pre' pads on the left and keeps the last maxlen ids.
+    out: preallocated matrix to write into
+    Returns (X, lengths clipped to maxlen)
+    '''
+    lengths = np.asarray(lengths, dtype='int64')
+    if maxlen is None:
+        maxlen = int(lengths.max()) if len(lengths) else 0
+    if padding not in ('pre', 'post'):
+        raise ValueError('Padding type "{}" not understood'.format(padding))
+    if truncating not in ('pre', 'post'):
+        raise ValueError('Truncating type "{}" not understood'.format(truncating))
+    if out is None:
+        out = np.empty((len(lengths), maxlen), dtype='int32')
+    kept = np.minimum(lengths, maxlen)
+    long_rows = np.flatnonzero(lengths > maxlen)
+    if len(long_rows):
+        # drop the ids outside the kept window of the long sequences: +1/-1 at the window ends, cumsum
+        starts = np.cumsum(lengths)[long_rows] - lengths[long_rows]
+        drop_start = starts if truncating == 'pre' else starts + maxlen
+        drop_end = starts + lengths[long_rows] - maxlen if truncating == 'pre' else starts + lengths[long_rows]
+        edges = np.zeros(len(ids) + 1, dtype='int8')
+        np.add.at(edges, drop_start, 1)
+        np.add.at(edges, drop_end, -1)
+        ids = ids[np.cumsum(edges[:-1]) == 0]
+    cols = np.arange(maxlen)
+    mask = cols >= (maxlen - kept)[:, None] if padding == 'pre' else cols < kept[:, None]
+    out.fill(value)
+    out[mask] = ids
+    return out, kept
+
+
+class RaggedTokens:
+    '''
+    Token ids of all the texts in one flat int32 array (CSR style): text i is ids[offsets[i]:offsets[i + 1]].
+    save()/load() keep the two arrays as .npy files, load(mmap_mode='r') maps them instead of reading them.
+    '''
+
+    def __init__(self, ids, lengths=None, offsets=None):
+        self.ids = ids
+        if offsets is None:
+            offsets = np.zeros(len(lengths) + 1, dtype='int64')
+            np.cumsum(lengths, out=offsets[1:])
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes
+
+    def pad(self, maxlen=None, **kwargs):
+        '''Returns (X, lengths) like pad_ragged'''
+        return pad_ragged(self.ids[self.offsets[0]:self.offsets[-1]], self.lengths, maxlen, **kwargs)
+
+    def take(self, indices):
+        '''RaggedTokens of the texts indices, in that order'''
+        lengths = self.lengths[indices]
+        shift = self.offsets[:-1][indices] - (np.cumsum(lengths) - lengths)
+        return RaggedTokens(self.ids[np.repeat(shift, lengths) + np.arange(lengths.sum())], lengths)
+
+    @classmethod
+    def from_padded(cls, X):
+        '''The non-zero ids of a padded matrix, row by row'''
+        tokens = X != 0
+        return cls(X[tokens].astype('int32'), tokens.sum(1))
+
+    def save(self, path):
+        np.save(path + '.ids.npy', self.ids)
+        np.save(path + '.offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        if not os.path.exists(path + '.ids.npy'):
+            # padded matrix of an older run
+            return cls.from_padded(np.load(path + '.npy'))
+        return cls(np.load(path + '.ids.npy', mmap_mode=mmap_mode), offsets=np.load(path + '.offsets.npy'))
+
+
+class RaggedDataset(Dataset):
+    '''Items are (ids of text indices[i], *tensors[i]), meant for a DataLoader with collate_fn=collate_ragged'''
+
+    def __init__(self, tokens, *tensors, indices=None):
+        self.tokens = tokens
+        self.tensors = tensors
+        self.indices = np.arange(len(tokens)) if indices is None else indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return (self.tokens[self.indices[index]],) + tuple(tensor[index] for tensor in self.tensors)
+
+
+def collate_ragged(batch):
+    '''Pad the ids that come first in every item into an int64 (batch, maxlen) tensor, default_collate the rest'''
+    seqs = [item[0] for item in batch]
+    lengths = np.fromiter(map(len, seqs), dtype='int64', count=len(seqs))
+    X, _ = pad_ragged(np.concatenate(seqs), lengths, maxlen, out=np.empty((len(seqs), maxlen), dtype='int64'))
+    return [torch.from_numpy(X)] + default_collate([item[1:] for item in batch])
+
+
+def fit_scaler(*features):
+    '''StandardScaler fitted batch by batch, without stacking train and test into one copy'''
+    scaler = StandardScaler()
+    for x in features:
+        scaler.partial_fit(x)
+    return scaler
+
+
 class DatasetWrapper(Dataset):
     def __init__(self, dataset, features, test=False):
         assert len(dataset) == len(features)
@@ -584,37 +1352,32 @@ def main():
     df_test = pd.read_csv('../input/test.csv')
     # preprocess
     t0 = time()
-    df_train = preprocess(df_train)
+    df_train = preprocess(df_train)  # features of the raw text come with it
     df_test = preprocess(df_test)
     X_train = df_train['question_text'].fillna('_na_').values
     X_test = df_test['question_text'].fillna('_na_').values
     logger.info('Preprocessed in {}'.format(time() - t0))
     # features
-    df_train = add_features(df_train)
-    df_test = add_features(df_test)
-    features_train = df_train[['capitals/length', 'words/uniques']].fillna(0)
-    features_test = df_test[['capitals/length', 'words/uniques']].fillna(0)
-    scaler = StandardScaler()
-    scaler.fit(np.vstack([features_train, features_test]))
+    features_train = df_train[feature_names].fillna(0)
+    features_test = df_test[feature_names].fillna(0)
+    scaler = fit_scaler(features_train, features_test)
     features_train = scaler.transform(features_train)
     features_test = scaler.transform(features_test)
     # tokenize
     t0 = time()
     tokenizer = Tokenizer(num_words=max_features)
     tokenizer.fit_on_texts(list(X_train))
-    X_train = tokenizer.texts_to_sequences(X_train)
-    X_test = tokenizer.texts_to_sequences(X_test)
+    X_train = tokenizer.texts_to_ragged(X_train)
+    X_test = tokenizer.texts_to_ragged(X_test)
     logger.info('Tokenized in {}'.format(time() - t0))
-    # padding
-    t0 = time()
-    X_train = pad_sequences(X_train, maxlen=maxlen)
-    X_test = pad_sequences(X_test, maxlen=maxlen)
-    logger.info('Padding in {}'.format(time() - t0))
+    # unpadded, each batch is padded to maxlen when it is collated
+    X_train = RaggedTokens(*X_train)
+    X_test = RaggedTokens(*X_test)
     # target
     y_train = df_train['target'].values
     # shuffle
     indices = np.random.permutation(len(X_train))
-    X_train, y_train = X_train[indices], y_train[indices]
+    X_train, y_train = X_train.take(indices), y_train[indices]
     features_train = features_train[indices]
     # embedding
     if debug:
@@ -628,21 +1391,22 @@ def main():
         gc.collect()
     logger.info('Created embeddings. Time {:.2f}s'.format(time() - start_time))
 
+    X_train.save('../input/X_train')
+    X_test.save('../input/X_test')
     np.save('../input/features_train.npy', features_train)
     np.save('../input/features_test.npy', features_test)
     '''
-    X_train = np.load('../input/X_train.npy')
+    X_train = RaggedTokens.load('../input/X_train')
     y_train = np.load('../input/y_train.npy')
-    X_test = np.load('../input/X_test.npy')
+    X_test = RaggedTokens.load('../input/X_test')
     embedding = np.load('../input/mean_embedding.npy')
     features_train = np.load('../input/features_train.npy')
     features_test = np.load('../input/features_test.npy')
     logger.info('Loaded data. Time {:.2f}'.format(time() - start_time))
 
     # data loader
-    test_dataset = TensorDataset(torch.from_numpy(X_test.astype('int64')))
-    test_dataset = DatasetWrapper(test_dataset, features_test, test=True)
-    test_loader = DataLoader(test_dataset, batch_size, shuffle=False)
+    test_dataset = DatasetWrapper(RaggedDataset(X_test), features_test, test=True)
+    test_loader = DataLoader(test_dataset, batch_size, shuffle=False, collate_fn=collate_ragged)
 
     proba_train, proba_test = np.zeros(len(X_train)), np.zeros(len(X_test))
     skf = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
@@ -650,21 +1414,27 @@ def main():
         fold_i += 1
         logger.info('Fold {}'.format(fold_i))
         # split
-        X_train_fold, y_train_fold = X_train[train_idx].astype('int64'), y_train[train_idx].astype('float32')
-        X_val_fold, y_val_fold = X_train[val_idx].astype('int64'), y_train[val_idx].astype('float32')
-        train_dataset = TensorDataset(torch.from_numpy(X_train_fold), torch.from_numpy(y_train_fold))
-        val_dataset = TensorDataset(torch.from_numpy(X_val_fold), torch.from_numpy(y_val_fold))
+        y_train_fold, y_val_fold = y_train[train_idx].astype('float32'), y_train[val_idx].astype('float32')
+        train_dataset = RaggedDataset(X_train, torch.from_numpy(y_train_fold), indices=train_idx)
+        val_dataset = RaggedDataset(X_train, torch.from_numpy(y_val_fold), indices=val_idx)
         features_train_fold = features_train[train_idx]
         features_val_fold = features_train[val_idx]
         train_dataset = DatasetWrapper(train_dataset, features_train_fold)
         val_dataset = DatasetWrapper(val_dataset, features_val_fold)
-        train_loader  = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-        val_loader = DataLoader(val_dataset, batch_size, shuffle=False)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_ragged)
+        val_loader = DataLoader(val_dataset, batch_size, shuffle=False, collate_fn=collate_ragged)
 
         # model
-        model = RNNCapsule(
-            max_features, embedding_dim=emb_size, embedding=embedding,
-            embedding_trainable=embedding_trainable, device=device).to(device)
+        if model_name == 'text_cnn':
+            model = TextCNN(
+                max_features, embedding_dim=emb_size, embedding=embedding,
+                embedding_trainable=embedding_trainable, embedding_dtype=emb_dtype, kernel_sizes=kernel_sizes,
+                n_filters=n_filters, device=device).to(device)
+        else:
+            model = RNNCapsule(
+                max_features, embedding_dim=emb_size, embedding=embedding,
+                embedding_trainable=embedding_trainable, embedding_dtype=emb_dtype, rnn=rnn, packed=packed,
+                device=device).to(device)
         # criterion = nn.BCEWithLogitsLoss()
         criterion = nn.BCELoss()
         optimizer = optim.Adam(model.parameters(), lr=lr)
@@ -675,15 +1445,19 @@ def main():
             if debug: break
             message = ''
             if epoch_i == epoch_unfreeze:
-                for param in model.parameters():
-                    param.requires_grad = True
+                unfreeze(model)
                 optimizer = optim.Adam(model.parameters(), lr=lr / 10)
                 message = 'Unfreezed. LR {}'.format(lr / 10)
+            t0 = time()
             loss = train(model, train_loader, criterion, optimizer, device)
+            t1 = time()
             validation = validate(model, val_loader, criterion, device)
-            logger.info('Fold {} Epoch {}/{} Train/Loss {:.4f} Val/Loss {:.4f} Val/F1 {:.4f} Threshold {:.2f} {}'.format(
+            t2 = time()
+            logger.info('Fold {} Epoch {}/{} Train/Loss {:.4f} Val/Loss {:.4f} Val/F1 {:.4f} Threshold {:.2f} '
+                        'Train {:.0f} samples/s Val {:.0f} samples/s {}'.format(
                 fold_i, epoch_i, epochs, loss,
                 validation['loss'], validation['f1'], validation['thresh'],
+                len(train_idx) / (t1 - t0), len(val_idx) / (t2 - t1),
                 message
                 )
             )
@@ -702,7 +1476,8 @@ def main():
 
     # submit
     f1, threshold = f1_score_for_thresholds(y_train, proba_train)
-    logger.info('Train/F1/Best {:.4f} (Threshold = {:.2f})'.format(f1, threshold))
+    logger.info('Train/F1/Best {:.4f} (Threshold = {:.2f}) Embedding {} Model {}'.format(
+        f1, threshold, emb_dtype, model_name if model_name == 'text_cnn' else '{} ({})'.format(model_name, rnn)))
 
     y_pred = (proba_test > threshold).astype('int')
     submit = pd.read_csv('../input/sample_submission.csv')
@@ -1,33 +1,39 @@
 from datetime import datetime; start = datetime.now()
 from time import time; start_time = time()
 from logging import getLogger, FileHandler, StreamHandler, Formatter, DEBUG, INFO
-import gc, os, random, re
+from collections import Counter
+from functools import lru_cache, partial
+from itertools import repeat
+from multiprocessing import Pool, Process, shared_memory
+import gc, hashlib, json, mmap, os, random, re
 
 import numpy as np
 import pandas as pd
 from sklearn import metrics
 from sklearn.model_selection import train_test_split, StratifiedKFold
 from sklearn.preprocessing import StandardScaler
-from tqdm import tqdm
-
-from keras.preprocessing.text import Tokenizer
-from keras.preprocessing.sequence import pad_sequences
 
 import torch
 from torch import nn, optim
 from torch.nn import functional as F
-from torch.utils.data import TensorDataset, DataLoader, Dataset
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.data import TensorDataset, DataLoader, Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
 
 
 # parameters
 debug = False
 one_epoch = False
 validate = True
+benchmark = False
 # model
 emb_size = 300
 max_features = 120000
 maxlen = 72
 embedding_trainable = False
+emb_dtype = 'float32'  # frozen embedding storage: 'float32', 'float16' or 'int8'
+rnn = 'lstm'  # recurrent block: 'lstm' (LSTM then GRU) or 'sru'
+packed = False  # run the LSTM/GRU on packed sequences, the padding skips the recurrence (the head masks it either way)
 n_capsule = 5
 capsule_dim = 5
 # data
@@ -37,6 +43,23 @@ emb_paths = {
     'paragram': '../input/embeddings/paragram_300_sl999/paragram_300_sl999.txt',
     # 'google': '../input/embeddings/GoogleNews-vectors-negative300/GoogleNews-vectors-negative300.bin'
 }
+emb_store_dir = 'emb_store'  # generated, kept out of the read-only ../input
+emb_use_store = True  # False: parse the text files with parse_emb_text
+emb_oov_fallback = True  # resolve OOV words from case/punctuation variants in the store
+n_jobs = os.cpu_count()
+preprocess_memo = True  # normalise each distinct token once, see normalise_memo
+memo_size = 2 ** 20
+csv_chunksize = None  # rows: stream train.csv/test.csv chunk by chunk with bounded memory
+ragged = False  # keep token ids unpadded (flat ids + offsets), pad each batch when it is collated
+ragged_dir = 'tokens'  # ragged tokens are saved here and memory-mapped back, None: kept in memory
+bucket_batches = False  # batch questions of similar length, each batch trimmed to its longest question
+bucket_size = 100  # batches per shuffled pool sorted by length
+emb_cache_dir = 'emb_cache'  # None: no cache
+emb_cache_size = 8
+emb_fusion = 'mean'  # 'mean', 'weighted' or 'concat'
+emb_weights = None  # {name: weight} for 'weighted'
+emb_concurrent = True  # load the sources in parallel processes
+emb_memory_limit = 8 * 2 ** 30  # bytes, estimated peak of the loads running at once
 batch_size = 512
 batch_size_val = 8192
 # training
@@ -67,6 +90,59 @@ logger.addHandler(fh)
 logger.addHandler(sh)
 
 
+class QuantizedEmbedding(nn.Module):
+    '''
+    Frozen nn.Embedding stored as float16 or int8 with a per-row scale.
+    Only the looked-up rows are dequantized to float32 in forward.
+    unfreeze() swaps in a float32 weight so training goes on as with nn.Embedding.
+    '''
+
+    def __init__(self, embedding, dtype='float16'):
+        super(QuantizedEmbedding, self).__init__()
+        embedding = torch.as_tensor(embedding, dtype=torch.float32)
+        self.dtype = dtype
+        if dtype == 'float16':
+            self.register_buffer('weight_q', embedding.half())
+            self.register_buffer('scale', None)
+        elif dtype == 'int8':
+            scale = embedding.abs().max(dim=1, keepdim=True)[0].clamp(min=1e-8) / 127.
+            self.register_buffer('weight_q', torch.round(embedding / scale).to(torch.int8))
+            self.register_buffer('scale', scale)
+        else:
+            raise NotImplementedError('No dtype: {}'.format(dtype))
+        self.register_parameter('weight', None)
+
+    def dequantize(self, x):
+        h = self.weight_q[x].float()
+        if self.scale is not None:
+            h = h * self.scale[x]
+        return h
+
+    def unfreeze(self):
+        if self.weight is None:
+            self.weight = nn.Parameter(self.dequantize(torch.arange(len(self.weight_q), device=self.weight_q.device)))
+            self.weight_q, self.scale = None, None
+
+    def forward(self, x):
+        if self.weight is not None:
+            return F.embedding(x, self.weight)
+        return self.dequantize(x)
+
+
+def make_embedding(vocab_size, embedding_dim, embedding=None, trainable=False, dtype='float32'):
+    '''
+    nn.Embedding initialised from embedding and frozen unless trainable,
+    or a QuantizedEmbedding for a frozen embedding stored as float16/int8 (unfreeze(model) swaps it back)
+    '''
+    if embedding is not None and dtype != 'float32' and not trainable:
+        return QuantizedEmbedding(embedding, dtype)
+    layer = nn.Embedding(vocab_size, embedding_dim)
+    if embedding is not None:
+        layer.weight = nn.Parameter(torch.tensor(embedding, dtype=torch.float32))
+        layer.weight.requires_grad = trainable
+    return layer
+
+
 class Attention(nn.Module):
     def __init__(self, hidden_size, step_size, bias=True, **kwargs):
         super(Attention, self).__init__()
@@ -79,44 +155,198 @@ class Attention(nn.Module):
         self.weight = nn.Parameter(weight)
         self.bias = nn.Parameter(torch.zeros(step_size)) if bias else None
 
-    def forward(self, x, mask=None):
-        eij = torch.mm(x.contiguous().view(-1, self.hidden_size), self.weight).view(-1, self.step_size)
+    def attention_weights(self, x, mask=None):
+        # batches can be trimmed to fewer steps than step_size, left padding aligns them on the last bias terms
+        step_size = x.size(1)
+        eij = torch.mm(x.contiguous().view(-1, self.hidden_size), self.weight).view(-1, step_size)
         if self.bias is not None:
-            eij += self.bias
+            eij += self.bias[self.step_size - step_size:]
         eij = torch.tanh(eij)
         a = torch.exp(eij)
-        if mask is not None:
-            a = a * mask
-        a = a / torch.sum(a, dim=1, keepdim=True) + 1e-10
+        if mask is None:
+            return a / torch.sum(a, dim=1, keepdim=True) + 1e-10
+        # the same arithmetic as without mask, so a row without padding gets the same weights bit for bit,
+        # and padding gets exactly zero weight
+        a = a.masked_fill(~mask, 0)
+        return (a / torch.sum(a, dim=1, keepdim=True) + 1e-10).masked_fill(~mask, 0)
+
+    def forward(self, x, mask=None):
+        a = self.attention_weights(x, mask)
         weighted = x * torch.unsqueeze(a, -1)
         return torch.sum(weighted, dim=1)
 
 
+class AttentionPooling(Attention):
+    '''
+    Attention, mean and max pooling of the same hidden states in one head, returns the three of them.
+    Without mask it computes exactly what Attention, torch.mean and torch.max did.
+    With mask, padding is left out of all three with the same arithmetic,
+    so a batch without padding gives bit-identical outputs either way.
+    '''
+
+    def forward(self, x, mask=None):
+        if mask is None:
+            return super(AttentionPooling, self).forward(x), torch.mean(x, 1), torch.max(x, 1)[0]
+        attn_pool = super(AttentionPooling, self).forward(x, mask)
+        mask_weights = mask.unsqueeze(-1).to(x.dtype)
+        # torch.mean of the masked states rescaled by steps / lengths, the scale is exactly 1 on full rows
+        avg_pool = torch.mean(x * mask_weights, 1) * (x.size(1) / mask_weights.sum(1))
+        max_pool = x.masked_fill(~mask.unsqueeze(-1), float('-inf')).max(1)[0]
+        return attn_pool, avg_pool, max_pool
+
+
+def padding_mask(x):
+    '''(mask, lengths) of the left-padded ids x, an all-padding row keeps its last step so that no sequence is empty'''
+    lengths = (x != 0).sum(1).clamp(min=1)
+    mask = torch.arange(x.size(1), device=x.device) >= (x.size(1) - lengths).unsqueeze(1)
+    return mask, lengths
+
+
+def realign(h, lengths, restore=False):
+    '''
+    Rotate the tokens of each row of the left-padded h to the front (right-padded, as packing expects),
+    restore: rotate the tokens of a right-padded h back to the end
+    '''
+    steps = torch.arange(h.size(1), device=h.device)
+    shift = (h.size(1) - lengths).unsqueeze(1)
+    index = (steps - shift if restore else steps + shift) % h.size(1)
+    return h.gather(1, index.unsqueeze(-1).expand(-1, -1, h.size(2)))
+
+
+def pack(h, lengths):
+    return pack_padded_sequence(realign(h, lengths), lengths.cpu(), batch_first=True, enforce_sorted=False)
+
+
+def unpack(h, lengths, total_length):
+    h, _ = pad_packed_sequence(h, batch_first=True, total_length=total_length)
+    return realign(h, lengths, restore=True)
+
+
+class SRURecurrence(torch.autograd.Function):
+    '''
+    c_t = f_t * c_(t-1) + u_t over the steps of (batch, steps, directions * hidden) u and f, from c0.
+    The hidden units of the second direction run from the last step to the first.
+    Both loops write into preallocated time-major buffers, and the backward loop is written out
+    so that autograd does not record a node per step.
+    '''
+
+    @staticmethod
+    def forward(ctx, u, f, c0, num_directions):
+        batch, seq, size = u.shape
+        hidden = size // num_directions
+        cs = u.new_empty(seq, batch, size)
+        for direction in range(num_directions):
+            d = slice(direction * hidden, (direction + 1) * hidden)
+            c = c0[:, d]
+            for t in (range(seq - 1, -1, -1) if direction == 1 else range(seq)):
+                c = torch.addcmul(u[:, t, d], f[:, t, d], c, out=cs[t, :, d])
+        ctx.save_for_backward(f, c0, cs)
+        ctx.num_directions = num_directions
+        return cs.transpose(0, 1)
+
+    @staticmethod
+    def backward(ctx, grad_cs):
+        f, c0, cs = ctx.saved_tensors
+        seq, batch, size = cs.shape
+        hidden = size // ctx.num_directions
+        grad_cs = grad_cs.transpose(0, 1)
+        grad_u, grad_f, grad_c0 = torch.empty_like(cs), torch.empty_like(cs), torch.empty_like(c0)
+        for direction in range(ctx.num_directions):
+            d = slice(direction * hidden, (direction + 1) * hidden)
+            g = c0.new_zeros(batch, hidden)
+            first, previous = (seq - 1, 1) if direction == 1 else (0, -1)
+            for t in (range(seq) if direction == 1 else range(seq - 1, -1, -1)):
+                g = torch.add(g, grad_cs[t, :, d], out=grad_u[t, :, d])
+                torch.mul(g, c0[:, d] if t == first else cs[t + previous, :, d], out=grad_f[t, :, d])
+                g = g * f[:, t, d]
+            grad_c0[:, d] = g
+        return grad_u.transpose(0, 1), grad_f.transpose(0, 1), grad_c0, None
+
+
+class SRU(nn.Module):
+    '''
+    Simple Recurrent Unit (Lei et al. 2017), a drop-in for nn.LSTM/nn.GRU with batch_first=True.
+    One matmul covers all the steps and directions, only c_t = f_t * c_(t-1) + (1 - f_t) * x~_t
+    is left to loop over the steps (SRURecurrence), and h_t = r_t * tanh(c_t) + (1 - r_t) * x_t
+    is elementwise again, x_t goes through a skip projection when its size differs from the output's.
+    Takes a PackedSequence as nn.LSTM does, the padding carries the state through unchanged so the backward
+    direction starts from hx at the last token of every sequence.
+    Returns (output, c_n)
+    '''
+
+    def __init__(
+        self, input_size, hidden_size, num_layers=1, bias=True, batch_first=True, dropout=0., bidirectional=False
+    ):
+        super(SRU, self).__init__()
+        assert batch_first
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.num_directions = 2 if bidirectional else 1
+        self.dropout = nn.Dropout(dropout)
+        self.layers = nn.ModuleList()
+        size = hidden_size * self.num_directions
+        for layer_i in range(num_layers):
+            layer_input_size = input_size if layer_i == 0 else size
+            # x~, forget gate, reset gate and the skip projection of x if needed, each for all directions
+            n_projections = 3 if layer_input_size == size else 4
+            self.layers.append(nn.Linear(layer_input_size, n_projections * size, bias=bias))
+
+    def forward(self, x, hx=None):
+        is_packed = isinstance(x, nn.utils.rnn.PackedSequence)
+        if is_packed:
+            x, lengths = pad_packed_sequence(x, batch_first=True)
+            padding = (torch.arange(x.size(1)) >= lengths.unsqueeze(1)).to(x.device).unsqueeze(-1)
+        bs = x.size(0)
+        size = self.hidden_size * self.num_directions
+        if hx is None:
+            hx = x.new_zeros(self.num_layers * self.num_directions, bs, self.hidden_size)
+        c_n = []
+        for layer_i, linear in enumerate(self.layers):
+            if layer_i > 0:
+                x = self.dropout(x)
+            projections = linear(x)
+            if projections.size(2) > 3 * size:
+                x_tilde, gates, skip = projections.split([size, 2 * size, size], 2)
+            else:
+                (x_tilde, gates), skip = projections.split([size, 2 * size], 2), x
+            f, r = torch.sigmoid(gates).chunk(2, 2)
+            u = torch.addcmul(x_tilde, f, x_tilde, value=-1)
+            if is_packed:
+                f, u = f.masked_fill(padding, 1), u.masked_fill(padding, 0)
+            c0 = hx[layer_i * self.num_directions:(layer_i + 1) * self.num_directions].transpose(0, 1).reshape(bs, -1)
+            cs = SRURecurrence.apply(u, f, c0, self.num_directions)
+            last = cs[torch.arange(bs), lengths.to(x.device) - 1] if is_packed else cs[:, -1]
+            c_n += [last[:, :self.hidden_size], cs[:, 0, self.hidden_size:]][:self.num_directions]
+            x = torch.addcmul(skip, r, torch.tanh(cs) - skip)
+        if is_packed:
+            x = pack_padded_sequence(x, lengths, batch_first=True, enforce_sorted=False)
+        return x, torch.stack(c_n)
+
+
 class RNNAttn(nn.Module):
 
     def __init__(
         self, vocab_size, embedding_size=300, embedding=None, embedding_trainable=False,
-        hidden_size=64, n_layers=1, device='cuda:0'
+        embedding_dtype='float32', hidden_size=64, n_layers=1, rnn='lstm', packed=False, device='cuda:0'
     ):
         super(RNNAttn, self).__init__()
         self.embedding_size = embedding_size
         self.hidden_size = 128
         self.n_layers = n_layers
+        self.packed = packed
         self.device = device
 
-        self.embedding = nn.Embedding(vocab_size, embedding_size)
-        if embedding is not None:
-            self.embedding.weight = nn.Parameter(torch.tensor(embedding, dtype=torch.float32))
-            self.embedding.weight.requires_grad = embedding_trainable
+        self.embedding = make_embedding(vocab_size, embedding_size, embedding, embedding_trainable, embedding_dtype)
         self.dropout_emb = nn.Dropout(0.1)
-        self.lstm = nn.LSTM(
+        lstm, gru = (nn.LSTM, nn.GRU) if rnn == 'lstm' else (SRU, SRU)
+        self.lstm = lstm(
             embedding_size, hidden_size, num_layers=n_layers, bias=True, batch_first=True, dropout=0.,
             bidirectional=True)
-        self.gru = nn.GRU(
+        self.gru = gru(
             hidden_size * 2, hidden_size, num_layers=n_layers, bias=True, batch_first=True, dropout=0.,
             bidirectional=True)
         self.attn_lstm = Attention(hidden_size * 2, maxlen)
-        self.attn_gru = Attention(hidden_size * 2, maxlen)
+        self.attn_gru = AttentionPooling(hidden_size * 2, maxlen)
         self.fc = nn.Linear(hidden_size * 2 * 4, 16)
         self.relu = nn.ReLU()
         self.dropout = nn.Dropout(0.1)
@@ -125,16 +355,21 @@ class RNNAttn(nn.Module):
     def forward(self, x):
         bs = x.size(0)
         seq = x.size(1)
+        # padding is masked out of the attention and pooling packed or not, even in batches without any
+        mask, lengths = padding_mask(x)
 
         x = self.embedding(x)
         x = self.dropout_emb(x.view(bs * seq, self.embedding_size))  # NOTE
         x = x.view(bs, seq, self.embedding_size)
-        h_lstm, _ = self.lstm(x)
-        h_gru, _ = self.gru(h_lstm)
-        h_attn_lstm = self.attn_lstm(h_lstm)
-        h_attn_gru = self.attn_gru(h_gru)
-        avg_pool = torch.mean(h_gru, 1)
-        max_pool, _ = torch.max(h_gru, 1)
+        if self.packed:
+            h_lstm, _ = self.lstm(pack(x, lengths))
+            h_gru, _ = self.gru(h_lstm)
+            h_lstm, h_gru = unpack(h_lstm, lengths, seq), unpack(h_gru, lengths, seq)
+        else:
+            h_lstm, _ = self.lstm(x)
+            h_gru, _ = self.gru(h_lstm)
+        h_attn_lstm = self.attn_lstm(h_lstm, mask)
+        h_attn_gru, avg_pool, max_pool = self.attn_gru(h_gru, mask)
         out = torch.cat([h_attn_lstm, h_attn_gru, avg_pool, max_pool], 1)
         out = self.relu(self.fc(out))
         out = self.dropout(out)
@@ -142,6 +377,14 @@ class RNNAttn(nn.Module):
         return out.squeeze()
 
 
+def unfreeze(model):
+    for module in model.modules():
+        if isinstance(module, QuantizedEmbedding):
+            module.unfreeze()
+    for param in model.parameters():
+        param.requires_grad = True
+
+
 def set_seed(seed):
     os.environ['PYTHONHASHSEED'] = str(seed)
     random.seed(seed)
@@ -152,19 +395,36 @@ def set_seed(seed):
     return seed
 
 
-def clean_punctuation(x):
-    puncts = [',', '.', '"', ':', ')', '(', '-', '!', '?', '|', ';', "'", '$', '&', '/', '[', ']', '>', '%', '=', '#', '*', '+', '\\', '•',  '~', '@', '£',
+puncts = [',', '.', '"', ':', ')', '(', '-', '!', '?', '|', ';', "'", '$', '&', '/', '[', ']', '>', '%', '=', '#', '*', '+', '\\', '•',  '~', '@', '£',
  '·', '_', '{', '}', '©', '^', '®', '`',  '<', '→', '°', '€', '™', '›',  '♥', '←', '×', '§', '″', '′', 'Â', '█', '½', 'à', '…',
  '“', '★', '”', '–', '●', 'â', '►', '−', '¢', '²', '¬', '░', '¶', '↑', '±', '¿', '▾', '═', '¦', '║', '―', '¥', '▓', '—', '‹', '─',
  '▒', '：', '¼', '⊕', '▼', '▪', '†', '■', '’', '▀', '¨', '▄', '♫', '☆', 'é', '¯', '♦', '¤', '▲', 'è', '¸', '¾', 'Ã', '⋅', '‘', '∞',
  '∙', '）', '↓', '、', '│', '（', '»', '，', '♪', '╩', '╚', '³', '・', '╦', '╣', '╔', '╗', '▬', '❤', 'ï', 'Ø', '¹', '≤', '‡', '√', ]
+punct_table = str.maketrans({punct: f' {punct} ' for punct in puncts})
+
+
+def clean_punctuation(x):
+    '''Single pass of clean_punctuation_replace: every punct is one character, listed once'''
+    return str(x).translate(punct_table)
+
+
+def clean_punctuation_replace(x):
     x = str(x)
     for punct in puncts:
         x = x.replace(punct, f' {punct} ')
     return x
 
 
+number_re = re.compile('[0-9]{2,}')
+number_marks = ['', '', '##', '###', '####', '#####']
+
+
 def clean_number(x):
+    '''Single pass of clean_number_sub: each run of 2-4 digits is masked with as many #, 5 or more with #####'''
+    return number_re.sub(lambda match: number_marks[min(len(match.group(0)), 5)], x)
+
+
+def clean_number_sub(x):
     x = re.sub('[0-9]{5,}', '#####', x)
     x = re.sub('[0-9]{4}', '####', x)
     x = re.sub('[0-9]{3}', '###', x)
@@ -172,67 +432,1075 @@ def clean_number(x):
     return x
 
 
-def _get_mispell(mispell_dict):
-    mispell_re = re.compile('(%s)' % '|'.join(mispell_dict.keys()))
-    return mispell_dict, mispell_re
+class MultiReplacer(object):
+    '''
+    Replace the keys of a mapping in one left-to-right pass, compiled once.
+    The keys are put in a trie that is compiled into a single regex. At each position the match is
+    the first key in mapping order, as with re.compile('|'.join(mapping.keys())).
+    whole_tokens: only replace keys that are whole space-separated tokens
+    '''
+
+    def __init__(self, mapping, whole_tokens=False):
+        self.mapping = mapping
+        trie = {}
+        for key in mapping:
+            node = trie
+            for ch in key:
+                if '' in node and not whole_tokens:
+                    break  # an earlier key is a prefix of this one and always matches first
+                node = node.setdefault(ch, {})
+            else:
+                node[''] = True
+        pattern = self._trie_pattern(trie)
+        if whole_tokens:
+            pattern = '(?<![^ ]){}(?![^ ])'.format(pattern)
+        self.regex = re.compile(pattern)
+
+    @classmethod
+    def _trie_pattern(cls, node):
+        branches = [re.escape(ch) + cls._trie_pattern(child) for ch, child in node.items() if ch != '']
+        if not branches:
+            return ''
+        if '' in node:
+            branches.append('')  # the key ending here comes after the longer, earlier keys
+        elif len(branches) == 1:
+            return branches[0]
+        return '(?:{})'.format('|'.join(branches))
+
+    def replace(self, match):
+        return self.mapping[match.group(0)]
+
+    def __call__(self, text):
+        return self.regex.sub(self.replace, text)
+
+
+typical_mispell_dict = {"ain't": "is not", "aren't": "are not","can't": "cannot", "'cause": "because", "could've": "could have", "couldn't": "could not", "didn't": "did not",  "doesn't": "does not", "don't": "do not", "hadn't": "had not", "hasn't": "has not", "haven't": "have not", "he'd": "he would","he'll": "he will", "he's": "he is", "how'd": "how did", "how'd'y": "how do you", "how'll": "how will", "how's": "how is",  "I'd": "I would", "I'd've": "I would have", "I'll": "I will", "I'll've": "I will have","I'm": "I am", "I've": "I have", "i'd": "i would", "i'd've": "i would have", "i'll": "i will",  "i'll've": "i will have","i'm": "i am", "i've": "i have", "isn't": "is not", "it'd": "it would", "it'd've": "it would have", "it'll": "it will", "it'll've": "it will have","it's": "it is", "let's": "let us", "ma'am": "madam", "mayn't": "may not", "might've": "might have","mightn't": "might not","mightn't've": "might not have", "must've": "must have", "mustn't": "must not", "mustn't've": "must not have", "needn't": "need not", "needn't've": "need not have","o'clock": "of the clock", "oughtn't": "ought not", "oughtn't've": "ought not have", "shan't": "shall not", "sha'n't": "shall not", "shan't've": "shall not have", "she'd": "she would", "she'd've": "she would have", "she'll": "she will", "she'll've": "she will have", "she's": "she is", "should've": "should have", "shouldn't": "should not", "shouldn't've": "should not have", "so've": "so have","so's": "so as", "this's": "this is","that'd": "that would", "that'd've": "that would have", "that's": "that is", "there'd": "there would", "there'd've": "there would have", "there's": "there is", "here's": "here is","they'd": "they would", "they'd've": "they would have", "they'll": "they will", "they'll've": "they will have", "they're": "they are", "they've": "they have", "to've": "to have", "wasn't": "was not", "we'd": "we would", "we'd've": "we would have", "we'll": "we will", "we'll've": "we will have", "we're": "we are", "we've": "we have", "weren't": "were not", "what'll": "what will", "what'll've": "what will have", "what're": "what are",  "what's": "what is", "what've": "what have", "when's": "when is", "when've": "when have", "where'd": "where did", "where's": "where is", "where've": "where have", "who'll": "who will", "who'll've": "who will have", "who's": "who is", "who've": "who have", "why's": "why is", "why've": "why have", "will've": "will have", "won't": "will not", "won't've": "will not have", "would've": "would have", "wouldn't": "would not", "wouldn't've": "would not have", "y'all": "you all", "y'all'd": "you all would","y'all'd've": "you all would have","y'all're": "you all are","y'all've": "you all have","you'd": "you would", "you'd've": "you would have", "you'll": "you will", "you'll've": "you will have", "you're": "you are", "you've": "you have", 'colour': 'color', 'centre': 'center', 'favourite': 'favorite', 'travelling': 'traveling', 'counselling': 'counseling', 'theatre': 'theater', 'cancelled': 'canceled', 'labour': 'labor', 'organisation': 'organization', 'wwii': 'world war 2', 'citicise': 'criticize', 'youtu ': 'youtube ', 'Qoura': 'Quora', 'sallary': 'salary', 'Whta': 'What', 'narcisist': 'narcissist', 'howdo': 'how do', 'whatare': 'what are', 'howcan': 'how can', 'howmuch': 'how much', 'howmany': 'how many', 'whydo': 'why do', 'doI': 'do I', 'theBest': 'the best', 'howdoes': 'how does', 'mastrubation': 'masturbation', 'mastrubate': 'masturbate', "mastrubating": 'masturbating', 'pennis': 'penis', 'Etherium': 'Ethereum', 'narcissit': 'narcissist', 'bigdata': 'big data', '2k17': '2017', '2k18': '2018', 'qouta': 'quota', 'exboyfriend': 'ex boyfriend', 'airhostess': 'air hostess', "whst": 'what', 'watsapp': 'whatsapp', 'demonitisation': 'demonetization', 'demonitization': 'demonetization', 'demonetisation': 'demonetization'}
+typical_mispell_replacer = MultiReplacer(typical_mispell_dict)
 
 
 def replace_typical_misspell(text):
-    mispell_dict = {"ain't": "is not", "aren't": "are not","can't": "cannot", "'cause": "because", "could've": "could have", "couldn't": "could not", "didn't": "did not",  "doesn't": "does not", "don't": "do not", "hadn't": "had not", "hasn't": "has not", "haven't": "have not", "he'd": "he would","he'll": "he will", "he's": "he is", "how'd": "how did", "how'd'y": "how do you", "how'll": "how will", "how's": "how is",  "I'd": "I would", "I'd've": "I would have", "I'll": "I will", "I'll've": "I will have","I'm": "I am", "I've": "I have", "i'd": "i would", "i'd've": "i would have", "i'll": "i will",  "i'll've": "i will have","i'm": "i am", "i've": "i have", "isn't": "is not", "it'd": "it would", "it'd've": "it would have", "it'll": "it will", "it'll've": "it will have","it's": "it is", "let's": "let us", "ma'am": "madam", "mayn't": "may not", "might've": "might have","mightn't": "might not","mightn't've": "might not have", "must've": "must have", "mustn't": "must not", "mustn't've": "must not have", "needn't": "need not", "needn't've": "need not have","o'clock": "of the clock", "oughtn't": "ought not", "oughtn't've": "ought not have", "shan't": "shall not", "sha'n't": "shall not", "shan't've": "shall not have", "she'd": "she would", "she'd've": "she would have", "she'll": "she will", "she'll've": "she will have", "she's": "she is", "should've": "should have", "shouldn't": "should not", "shouldn't've": "should not have", "so've": "so have","so's": "so as", "this's": "this is","that'd": "that would", "that'd've": "that would have", "that's": "that is", "there'd": "there would", "there'd've": "there would have", "there's": "there is", "here's": "here is","they'd": "they would", "they'd've": "they would have", "they'll": "they will", "they'll've": "they will have", "they're": "they are", "they've": "they have", "to've": "to have", "wasn't": "was not", "we'd": "we would", "we'd've": "we would have", "we'll": "we will", "we'll've": "we will have", "we're": "we are", "we've": "we have", "weren't": "were not", "what'll": "what will", "what'll've": "what will have", "what're": "what are",  "what's": "what is", "what've": "what have", "when's": "when is", "when've": "when have", "where'd": "where did", "where's": "where is", "where've": "where have", "who'll": "who will", "who'll've": "who will have", "who's": "who is", "who've": "who have", "why's": "why is", "why've": "why have", "will've": "will have", "won't": "will not", "won't've": "will not have", "would've": "would have", "wouldn't": "would not", "wouldn't've": "would not have", "y'all": "you all", "y'all'd": "you all would","y'all'd've": "you all would have","y'all're": "you all are","y'all've": "you all have","you'd": "you would", "you'd've": "you would have", "you'll": "you will", "you'll've": "you will have", "you're": "you are", "you've": "you have", 'colour': 'color', 'centre': 'center', 'favourite': 'favorite', 'travelling': 'traveling', 'counselling': 'counseling', 'theatre': 'theater', 'cancelled': 'canceled', 'labour': 'labor', 'organisation': 'organization', 'wwii': 'world war 2', 'citicise': 'criticize', 'youtu ': 'youtube ', 'Qoura': 'Quora', 'sallary': 'salary', 'Whta': 'What', 'narcisist': 'narcissist', 'howdo': 'how do', 'whatare': 'what are', 'howcan': 'how can', 'howmuch': 'how much', 'howmany': 'how many', 'whydo': 'why do', 'doI': 'do I', 'theBest': 'the best', 'howdoes': 'how does', 'mastrubation': 'masturbation', 'mastrubate': 'masturbate', "mastrubating": 'masturbating', 'pennis': 'penis', 'Etherium': 'Ethereum', 'narcissit': 'narcissist', 'bigdata': 'big data', '2k17': '2017', '2k18': '2018', 'qouta': 'quota', 'exboyfriend': 'ex boyfriend', 'airhostess': 'air hostess', "whst": 'what', 'watsapp': 'whatsapp', 'demonitisation': 'demonetization', 'demonitization': 'demonetization', 'demonetisation': 'demonetization'}
-    mispellings, mispellings_re = _get_mispell(mispell_dict)
-    def replace(match):
-        return mispellings[match.group(0)]
-    return mispellings_re.sub(replace, text)
+    return typical_mispell_replacer(text)
+
+
+preprocess_stages = [
+    ('lower', str.lower),
+    ('clean_punctuation', clean_punctuation),
+    ('clean_number', clean_number),
+    ('replace_typical_misspell', replace_typical_misspell),
+]
+feature_stages = []  # (name, fn) on the raw text, e.g. ('length', len)
+
+
+def normalise(text):
+    return replace_typical_misspell(clean_number(clean_punctuation(text.lower())))
+
+
+# a misspelling with a space matches across tokens only where a token ends with its part before that space
+typical_mispell_boundaries = tuple(
+    key[:i] for key in typical_mispell_dict for i, ch in enumerate(key) if ch == ' ')
+
+
+# seconds spent in this process on each of preprocess_stages by the memo misses, then on the string-level fallback
+memo_timings = [0.] * (len(preprocess_stages) + 1)
+
+
+@lru_cache(maxsize=memo_size)
+def _normalise_token(token):
+    '''normalise(token), None if a misspelling could match from this token into the next one'''
+    for k, (_, fn) in enumerate(preprocess_stages):
+        if fn is replace_typical_misspell and token.endswith(typical_mispell_boundaries):
+            return None
+        t0 = time()
+        token = fn(token)
+        memo_timings[k] += time() - t0
+    return token
+
+
+def normalise_memo(text):
+    '''
+    normalise(text) with each space-separated token transformed once through an LRU memo.
+    The stages are token-local except misspellings containing a space,
+    texts where one of them could match across tokens take the string-level path.
+    '''
+    tokens = list(map(_normalise_token, text.split(' ')))
+    if None in tokens:
+        t0 = time()
+        text = normalise(text)
+        memo_timings[-1] += time() - t0
+        return text
+    return ' '.join(tokens)
+
+
+def _preprocess_shard(texts):
+    timings = []
+    features = []
+    for name, fn in feature_stages:
+        t0 = time()
+        features.append([fn(text) for text in texts])
+        timings.append(time() - t0)
+    memo_info = _normalise_token.cache_info()
+    memo_start = list(memo_timings)
+    for name, fn in [('normalise_memo', normalise_memo)] if preprocess_memo else preprocess_stages:
+        t0 = time()
+        texts = [fn(text) for text in texts]
+        timings.append(time() - t0)
+    if preprocess_memo:
+        # the stages ran on the memo misses only, the total above also covers the lookups of the hits
+        timings[len(feature_stages):len(feature_stages)] = [t - t0 for t, t0 in zip(memo_timings, memo_start)]
+    memo_hits = _normalise_token.cache_info().hits - memo_info.hits
+    memo_misses = _normalise_token.cache_info().misses - memo_info.misses
+    return texts, features, timings, (memo_hits, memo_misses)
+
+
+def preprocess_texts(texts, n_workers=None, pool=None):
+    '''
+    Run feature_stages and the preprocess_stages chain over texts, sharded across a process pool.
+    Each worker runs the whole chain on its shard, shards come back in the original order.
+    pool: reuse a running Pool (and the memo of its workers) across calls
+    Returns (texts, {feature name: values})
+    '''
+    t0 = time()
+    n_workers = pool._processes if pool is not None else n_workers or n_jobs
+    n_shards = max(min(len(texts), n_workers * 4), 1)
+    bounds = np.linspace(0, len(texts), n_shards + 1).astype('int64')
+    shards = [texts[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+    if pool is not None:
+        results = pool.map(_preprocess_shard, shards)
+    elif n_workers > 1:
+        with Pool(n_workers) as pool:
+            results = pool.map(_preprocess_shard, shards)
+    else:
+        results = [_preprocess_shard(shard) for shard in shards]
+    texts = [text for shard_texts, _, _, _ in results for text in shard_texts]
+    features = {
+        name: np.concatenate([shard_features[k] for _, shard_features, _, _ in results])
+        for k, (name, _) in enumerate(feature_stages)}
+    # CPU time of each stage summed over the workers
+    timings = np.sum([shard_timings for _, _, shard_timings, _ in results], axis=0)
+    stages = feature_stages + preprocess_stages
+    if preprocess_memo:
+        stages = stages + [('string_fallback', None), ('normalise_memo total', None)]
+    message = ', '.join('{} {:.2f}s'.format(name, t) for (name, _), t in zip(stages, timings))
+    if preprocess_memo:
+        hits, misses = np.sum([memo for _, _, _, memo in results], axis=0)
+        message += ' (memo hit rate {:.2%})'.format(hits / max(hits + misses, 1))
+    logger.info('Preprocessed {} texts on {} workers in {:.2f}s: {}'.format(
+        len(texts), n_workers, time() - t0, message))
+    return texts, features
+
+
+def split_texts(texts, filter_table, lower=True, split=' '):
+    '''
+    The words of all texts from a single str.split of the texts joined by a marker char none of them contains.
+    Returns (words, marker), the empty strings left by repeated separators are kept for callers to drop.
+    '''
+    if lower:
+        texts = map(str.lower, texts)
+    if filter_table:
+        texts = (text.translate(filter_table) for text in texts)
+    texts = list(texts)
+    chars = ''.join(texts) + split
+    marker = next(c for c in map(chr, range(0x110000)) if c not in chars)
+    return (split + marker + split).join(texts).split(split), marker
+
+
+def _count_words(args):
+    texts, filter_table, lower, split = args
+    words, marker = split_texts(texts, filter_table, lower, split)
+    word_counts = Counter(words)
+    word_counts.pop('', None)
+    word_counts.pop(marker, None)
+    # the words of each text lie between two markers of the same split
+    word_docs = Counter()
+    start = 0
+    for _ in range(len(texts) - 1):
+        end = words.index(marker, start)
+        word_docs.update(set(words[start:end]))
+        start = end + 1
+    word_docs.update(set(words[start:]))
+    word_docs.pop('', None)
+    return len(texts), word_counts, word_docs
+
+
+class Tokenizer:
+    '''
+    Drop-in for keras.preprocessing.text.Tokenizer (word level) without importing keras.
+    Same word_index: words ranked by count, ties in order of first occurrence, oov_token forced to 1.
+    Same sequences: words with index >= num_words and unseen words are dropped, or become oov_token.
+    fit_on_texts counts shards on a process pool and merges them in order,
+    texts_to_sequences looks up all the words of all texts in one flat pass.
+    '''
+    def __init__(
+        self, num_words=None, filters='!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n', lower=True,
+        split=' ', oov_token=None
+    ):
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.oov_token = oov_token
+        self.filter_table = str.maketrans({c: split for c in filters})
+        self.word_counts = Counter()
+        self.word_docs = Counter()
+        self.document_count = 0
+        self.word_index = {}
+        self.index_word = {}
+
+    def fit_on_texts(self, texts, n_workers=None, pool=None):
+        n_workers = pool._processes if pool is not None else n_workers or n_jobs
+        n_shards = max(min(len(texts) // 10000, n_workers * 4), 1)
+        bounds = np.linspace(0, len(texts), n_shards + 1).astype('int64')
+        shards = [(texts[a:b], self.filter_table, self.lower, self.split) for a, b in zip(bounds[:-1], bounds[1:])]
+        if pool is not None:
+            results = pool.map(_count_words, shards)
+        elif n_workers > 1 and n_shards > 1:
+            with Pool(n_workers) as pool:
+                results = pool.map(_count_words, shards)
+        else:
+            results = [_count_words(shard) for shard in shards]
+        # merging in shard order keeps the words in order of first occurrence for the tie-break
+        for document_count, word_counts, word_docs in results:
+            self.document_count += document_count
+            self.word_counts.update(word_counts)
+            self.word_docs.update(word_docs)
+        vocab = [] if self.oov_token is None else [self.oov_token]
+        vocab.extend(word for word, _ in sorted(self.word_counts.items(), key=lambda item: item[1], reverse=True))
+        self.word_index = {word: i for i, word in enumerate(vocab, 1)}
+        self.index_word = {i: word for word, i in self.word_index.items()}
+
+    def texts_to_ragged(self, texts):
+        '''Returns (flat int32 indices of all the texts, int64 lengths)'''
+        oov_index = self.word_index.get(self.oov_token, 0)
+        # word -> output index, 0 for the words keras drops, -1 between texts
+        lookup = {
+            word: i if not self.num_words or i < self.num_words else oov_index
+            for word, i in self.word_index.items()}
+        words, marker = split_texts(texts, self.filter_table, self.lower, self.split)
+        lookup[''] = 0
+        lookup[marker] = -1
+        ids = np.fromiter(map(lookup.get, words, repeat(oov_index)), dtype='int32', count=len(words))
+        text_ids = np.cumsum(ids == -1)
+        keep = ids > 0
+        return ids[keep], np.bincount(text_ids[keep], minlength=len(texts))
+
+    def texts_to_sequences(self, texts):
+        ids, lengths = self.texts_to_ragged(texts)
+        ids, ends = ids.tolist(), np.cumsum(lengths).tolist()
+        return [ids[a:b] for a, b in zip([0] + ends[:-1], ends)]
+
+
+def pad_ragged(ids, lengths, maxlen=None, padding='pre', truncating='pre', value=0, out=None):
+    '''
+    Write the flat ids of consecutive sequences into a (len(lengths), maxlen) int32 matrix with one boolean mask assignment.
+    padding/truncating follow keras' pad_sequences: 'pre' pads on the left and keeps the last maxlen ids.
+    out: preallocated matrix to write into
+    Returns (X, lengths clipped to maxlen)
+    '''
+    lengths = np.asarray(lengths, dtype='int64')
+    if maxlen is None:
+        maxlen = int(lengths.max()) if len(lengths) else 0
+    if padding not in ('pre', 'post'):
+        raise ValueError('Padding type "{}" not understood'.format(padding))
+    if truncating not in ('pre', 'post'):
+        raise ValueError('Truncating type "{}" not understood'.format(truncating))
+    if out is None:
+        out = np.empty((len(lengths), maxlen), dtype='int32')
+    kept = np.minimum(lengths, maxlen)
+    long_rows = np.flatnonzero(lengths > maxlen)
+    if len(long_rows):
+        # drop the ids outside the kept window of the long sequences: +1/-1 at the window ends, cumsum
+        starts = np.cumsum(lengths)[long_rows] - lengths[long_rows]
+        drop_start = starts if truncating == 'pre' else starts + maxlen
+        drop_end = starts + lengths[long_rows] - maxlen if truncating == 'pre' else starts + lengths[long_rows]
+        edges = np.zeros(len(ids) + 1, dtype='int8')
+        np.add.at(edges, drop_start, 1)
+        np.add.at(edges, drop_end, -1)
+        ids = ids[np.cumsum(edges[:-1]) == 0]
+    cols = np.arange(maxlen)
+    mask = cols >= (maxlen - kept)[:, None] if padding == 'pre' else cols < kept[:, None]
+    out.fill(value)
+    out[mask] = ids
+    return out, kept
+
+
+class RaggedTokens:
+    '''
+    Token ids of all the texts in one flat int32 array (CSR style): text i is ids[offsets[i]:offsets[i + 1]].
+    save()/load() keep the two arrays as .npy files, load(mmap_mode='r') maps them instead of reading them.
+    '''
+
+    def __init__(self, ids, lengths=None, offsets=None):
+        self.ids = ids
+        if offsets is None:
+            offsets = np.zeros(len(lengths) + 1, dtype='int64')
+            np.cumsum(lengths, out=offsets[1:])
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.ids.nbytes + self.offsets.nbytes
+
+    def pad(self, maxlen=None, **kwargs):
+        '''Returns (X, lengths) like pad_ragged'''
+        return pad_ragged(self.ids[self.offsets[0]:self.offsets[-1]], self.lengths, maxlen, **kwargs)
+
+    def take(self, indices):
+        '''RaggedTokens of the texts indices, in that order'''
+        lengths = self.lengths[indices]
+        shift = self.offsets[:-1][indices] - (np.cumsum(lengths) - lengths)
+        return RaggedTokens(self.ids[np.repeat(shift, lengths) + np.arange(lengths.sum())], lengths)
+
+    @classmethod
+    def from_padded(cls, X):
+        '''The non-zero ids of a padded matrix, row by row'''
+        tokens = X != 0
+        return cls(X[tokens].astype('int32'), tokens.sum(1))
+
+    def save(self, path):
+        np.save(path + '.ids.npy', self.ids)
+        np.save(path + '.offsets.npy', self.offsets)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        if not os.path.exists(path + '.ids.npy'):
+            # padded matrix of an older run
+            return cls.from_padded(np.load(path + '.npy'))
+        return cls(np.load(path + '.ids.npy', mmap_mode=mmap_mode), offsets=np.load(path + '.offsets.npy'))
+
+
+class RaggedDataset(Dataset):
+    '''Items are (ids of text indices[i], *tensors[i]), meant for a DataLoader with collate_fn=collate_ragged'''
+
+    def __init__(self, tokens, *tensors, indices=None):
+        self.tokens = tokens
+        self.tensors = tensors
+        self.indices = np.arange(len(tokens)) if indices is None else indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return (self.tokens[self.indices[index]],) + tuple(tensor[index] for tensor in self.tensors)
+
+
+def collate_ragged(batch, trim=False):
+    '''
+    Pad the ids of the batch and stack the rest, as TensorDataset batches come.
+    Pads to maxlen, or with trim to the longest question of the batch
+    '''
+    seqs, *rest = zip(*batch)
+    lengths = np.fromiter(map(len, seqs), dtype='int64', count=len(seqs))
+    X, _ = pad_ragged(np.concatenate(seqs), lengths, min(max(lengths.max(), 1), maxlen) if trim else maxlen)
+    return (torch.from_numpy(X),) + tuple(torch.stack(values) for values in rest)
+
+
+def collate_trimmed(batch):
+    '''default_collate, then drop the leading columns that are padding in every row of the batch'''
+    inputs, *rest = default_collate(batch)
+    tokens = (inputs != 0).any(0)
+    start = tokens.int().argmax().item() if tokens.any() else inputs.size(1) - 1
+    return [inputs[:, start:]] + rest
+
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batches of indices of similar lengths.
+    shuffle: sort random pools of bucket_size batches by length and yield their batches in random order,
+    else: yield batches in order of length, order maps the outputs back (outputs[order] = outputs)
+    '''
+
+    def __init__(self, lengths, batch_size, shuffle=False, bucket_size=bucket_size):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.order = None if shuffle else np.argsort(self.lengths, kind='stable')
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.bucket_size
+            batches = []
+            for a in range(0, len(indices), pool_size):
+                pool = indices[a:a + pool_size]
+                pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+                batches += [pool[b:b + self.batch_size] for b in range(0, len(pool), self.batch_size)]
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        else:
+            batches = [self.order[b:b + self.batch_size] for b in range(0, len(self.order), self.batch_size)]
+        for batch in batches:
+            yield batch.tolist()
+
+
+def make_loader(X, lengths, *tensors, indices=None, shuffle=False, ragged=False, bucket_batches=False):
+    '''
+    DataLoader over the rows indices of X and tensors.
+    ragged: X is a RaggedTokens padded batch by batch, else a padded matrix
+    bucket_batches: batches of similar lengths, each trimmed to its longest question
+    '''
+    if ragged:
+        dataset = RaggedDataset(X, *tensors, indices=indices)
+        collate_fn = partial(collate_ragged, trim=bucket_batches)
+    else:
+        dataset = TensorDataset(torch.from_numpy(X if indices is None else X[indices]), *tensors)
+        collate_fn = collate_trimmed if bucket_batches else None
+    if bucket_batches:
+        sampler = BucketBatchSampler(lengths if indices is None else lengths[indices], batch_size, shuffle=shuffle)
+        return DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn)
+    return DataLoader(dataset, batch_size, shuffle=shuffle, collate_fn=collate_fn)
+
+
+def unsort(outputs, data_loader):
+    '''outputs of data_loader back in dataset order when its batches come sorted by length'''
+    order = getattr(data_loader.batch_sampler, 'order', None)
+    if order is None:
+        return outputs
+    unsorted = np.empty_like(outputs)
+    unsorted[order] = outputs
+    return unsorted
+
+
+def fit_tokenizer_streaming(path, tokenizer, pool=None):
+    '''Fit tokenizer on the preprocessed questions of path, csv_chunksize rows at a time. Returns the number of rows'''
+    n_rows = 0
+    for chunk in pd.read_csv(path, chunksize=csv_chunksize, usecols=['question_text']):
+        texts, _ = preprocess_texts(chunk['question_text'].tolist(), pool=pool)
+        tokenizer.fit_on_texts(texts, pool=pool)
+        n_rows += len(chunk)
+    return n_rows
+
+
+def encode_streaming(path, tokenizer, n_rows=None, pool=None, target=False):
+    '''
+    Preprocess, tokenize and pad path csv_chunksize rows at a time into preallocated arrays,
+    so only one chunk of raw text, cleaned text and token lists is alive at once.
+    With ragged, X is a RaggedTokens of the unpadded ids instead.
+    Returns (X, lengths, y), y is None without target
+    '''
+    if n_rows is None:
+        n_rows = sum(len(chunk) for chunk in pd.read_csv(path, chunksize=csv_chunksize, usecols=['qid']))
+    X = [] if ragged else np.zeros((n_rows, maxlen), dtype='int32')
+    lengths = np.zeros(n_rows, dtype='int64')
+    y = np.zeros(n_rows, dtype='int64') if target else None
+    a = 0
+    for chunk in pd.read_csv(path, chunksize=csv_chunksize):
+        texts, _ = preprocess_texts(chunk['question_text'].tolist(), pool=pool)
+        b = a + len(chunk)
+        if ragged:
+            ids, lengths[a:b] = tokenizer.texts_to_ragged(texts)
+            X.append(ids)
+        else:
+            _, lengths[a:b] = pad_ragged(*tokenizer.texts_to_ragged(texts), maxlen=maxlen, out=X[a:b])
+        if target:
+            y[a:b] = chunk['target'].values
+        a = b
+        del chunk, texts
+    if ragged:
+        X = RaggedTokens(np.concatenate(X), lengths)
+    return X, lengths, y
 
 
 def preprocess(df):
-    df['question_text'] = df['question_text'].apply(lambda text: clean_punctuation(text.lower()))
-    df['question_text'] = df['question_text'].apply(lambda text: clean_number(text))
-    df['question_text'] = df['question_text'].apply(lambda text: replace_typical_misspell(text))
+    texts, features = preprocess_texts(df['question_text'].tolist())
+    df['question_text'] = texts
+    for name, values in features.items():
+        df[name] = values
     return df
 
 
-def get_coefs(word, *arr):
-    return word, np.asarray(arr, dtype='float32')
-
-
-def get_embedding(path, word_index, name='glove'):
-    if name.lower() == 'glove':
-        embeddings_index = dict(
-            get_coefs(*o.split(' ')) for o in open(path, encoding='utf-8', errors='ignore'))
-        emb_mean, emb_std = -0.005838499, 0.48782197
-        emb_size = 300
-    elif name.lower() == 'fasttext':
-        embeddings_index = dict(get_coefs(*o.split(" ")) for o in open(path) if len(o) > 100)
-        emb_mean, emb_std = -0.0033469985, 0.109855495
-        emb_size = 300
-    elif name.lower() == 'paragram':
-        embeddings_index = dict(
-            get_coefs(*o.split(" "))
-            for o in open(path, encoding='utf-8', errors='ignore') if len(o) > 100)
-        emb_mean, emb_std = -0.0053247833, 0.49346462
-        emb_size = 300
-    elif name.lower() == 'google':
-        loaded = KeyedVectors.load_word2vec_format(path, binary=True)
-        embeddings_index = dict([(k, loaded[k]) for k in loaded.vocab.keys()])
-        emb_mean, emb_std = -0.003527845, 0.13315111
-        emb_size = 300
+def _word_hash(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def _file_identity(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _block_stats(values):
+    '''(count, mean, M2) of a block of values'''
+    mean = values.mean(dtype='float64')
+    return values.size, mean, ((values - mean) ** 2).sum(dtype='float64')
+
+
+def _merge_stats(a, b):
+    '''
+    Combine two (count, mean, M2) of Welford's algorithm
+    cf. https://en.wikipedia.org/wiki/Algorithms_for_calculating_variance#Parallel_algorithm
+    '''
+    (n_a, mean_a, m2_a), (n_b, mean_b, m2_b) = a, b
+    n = n_a + n_b
+    if n == 0:
+        return a
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def load_emb_stats(path, name, store_dir=emb_store_dir):
+    '''emb_mean/emb_std saved next to the embedding, None if missing or stale'''
+    stats_path = os.path.join(store_dir, name, 'stats.json')
+    if not os.path.exists(stats_path):
+        return None
+    with open(stats_path) as f:
+        stats = json.load(f)
+    return stats if stats['source'] == _file_identity(path) else None
+
+
+def save_emb_stats(path, name, stats, store_dir=emb_store_dir):
+    count, mean, m2 = stats
+    stats = {'count': int(count), 'mean': float(mean), 'std': float(np.sqrt(m2 / count)),
+             'source': _file_identity(path)}
+    os.makedirs(os.path.join(store_dir, name), exist_ok=True)
+    with open(os.path.join(store_dir, name, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+    logger.info('Embedding stats {}: mean {:.6f} std {:.6f}'.format(name, stats['mean'], stats['std']))
+    return stats
+
+
+def _write_emb_block(f_vec, block, stats):
+    block = np.stack(block)
+    f_vec.write(block.tobytes())
+    return _merge_stats(stats, _block_stats(block))
+
+
+def build_emb_store(path, name, store_dir=emb_store_dir):
+    '''
+    One-time conversion of a text embedding file into {store_dir}/{name}/
+    - vectors.f32: contiguous float32 matrix (n_words, emb_size) for np.memmap
+    - keys.npy / rows.npy: sorted word hashes and their rows in vectors.f32
+    - fold_keys.npy / fold_rows.npy: the same for folded words, see build_fold_index
+    - words.txt / meta.json / stats.json (mean and std from the same pass)
+    '''
+    t0 = time()
+    out_dir = os.path.join(store_dir, name)
+    os.makedirs(out_dir, exist_ok=True)
+    words, block, stats = [], [], (0, 0., 0.)
+    with open(path, encoding='utf-8', errors='ignore') as f, \
+            open(os.path.join(out_dir, 'vectors.f32'), 'wb') as f_vec:
+        for o in f:
+            values = o.rstrip().rsplit(' ', emb_size)
+            if len(values) != emb_size + 1: continue  # noqa: header or broken line
+            block.append(np.asarray(values[1:], dtype='float32'))
+            words.append(values[0])
+            if len(block) == 4096:
+                stats = _write_emb_block(f_vec, block, stats)
+                block = []
+        if block:
+            stats = _write_emb_block(f_vec, block, stats)
+    with open(os.path.join(out_dir, 'words.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words))
+
+    # the last occurrence of a duplicated word wins, as when the vectors were read into a dict
+    keys = np.array([_word_hash(word) for word in words], dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    last = np.append(keys[1:] != keys[:-1], True)
+    np.save(os.path.join(out_dir, 'keys.npy'), keys[last])
+    np.save(os.path.join(out_dir, 'rows.npy'), order[last])
+    build_fold_index(out_dir, words)
+
+    meta = {'name': name, 'n_words': len(words), 'emb_size': emb_size, 'source': _file_identity(path)}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    save_emb_stats(path, name, stats, store_dir=store_dir)
+    logger.info('Built embedding store {} ({} words) in {:.2f}s'.format(name, len(words), time() - t0))
+    return meta
+
+
+def open_emb_store(name, store_dir=emb_store_dir):
+    store_dir = os.path.join(store_dir, name)
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    vectors = np.memmap(
+        os.path.join(store_dir, 'vectors.f32'), dtype='float32', mode='r',
+        shape=(meta['n_words'], meta['emb_size']))
+    keys = np.load(os.path.join(store_dir, 'keys.npy'), mmap_mode='r')
+    rows = np.load(os.path.join(store_dir, 'rows.npy'), mmap_mode='r')
+    if not os.path.exists(os.path.join(store_dir, 'fold_keys.npy')):
+        with open(os.path.join(store_dir, 'words.txt'), encoding='utf-8') as f:
+            build_fold_index(store_dir, f.read().split('\n'))
+    fold_keys = np.load(os.path.join(store_dir, 'fold_keys.npy'), mmap_mode='r')
+    fold_rows = np.load(os.path.join(store_dir, 'fold_rows.npy'), mmap_mode='r')
+    return {'vectors': vectors, 'keys': keys, 'rows': rows, 'fold_keys': fold_keys, 'fold_rows': fold_rows,
+            'meta': meta}
+
+
+def emb_store_is_fresh(path, name, store_dir=emb_store_dir):
+    meta_path = os.path.join(store_dir, name, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta['source'] == _file_identity(path)
+
+
+def lookup_emb_store(store, words, index=''):
+    '''Rows of words in the store ({index}keys / {index}rows), -1 for words not in it'''
+    keys, rows = store[index + 'keys'], store[index + 'rows']
+    hashes = np.array([_word_hash(word) for word in words], dtype=np.uint64)
+    pos = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+    return np.where(keys[pos] == hashes, rows[pos], -1)
+
+
+def fold_word(word):
+    return word.lower().strip(oov_punctuation)
+
+
+def build_fold_index(out_dir, words):
+    '''
+    Secondary index of the store on fold_word (lowercase, punctuation stripped),
+    a folded key shared by several words points to the first (most frequent) of them.
+    Words made only of punctuation fold to '' and are left out, they would all share one arbitrary row.
+    '''
+    folded = [fold_word(word) for word in words]
+    rows = np.array([i for i, word in enumerate(folded) if word], dtype='int64')
+    keys = np.array([_word_hash(word) for word in folded if word], dtype=np.uint64)
+    order = np.argsort(keys, kind='stable')
+    keys, order = keys[order], rows[order]
+    first = np.insert(keys[1:] != keys[:-1], 0, True)
+    np.save(os.path.join(out_dir, 'fold_keys.npy'), keys[first])
+    np.save(os.path.join(out_dir, 'fold_rows.npy'), order[first])
+
+
+oov_punctuation = '!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~“”‘’«»¿¡'
+oov_rules = [
+    ('lower', str.lower, ''),
+    ('capitalize', str.capitalize, ''),
+    ('upper', str.upper, ''),
+    ('fold', fold_word, 'fold_'),
+]
+
+
+def resolve_oov(store, words, rows, name=''):
+    '''
+    Rows for the OOV words (-1) from their variants, one batched lookup per rule of oov_rules.
+    Logs the coverage gained by each rule.
+    '''
+    rows = np.array(rows)
+    report = ['{} coverage {:.2%}'.format(name, (rows >= 0).mean())]
+    for rule, variant, index in oov_rules:
+        missing = np.flatnonzero(rows < 0)
+        if len(missing) == 0: break  # noqa
+        variants = [variant(words[j]) for j in missing]
+        # a word that folds to '' (punctuation only, number masks like '####') has no variant
+        missing, variants = missing[[bool(v) for v in variants]], [v for v in variants if v]
+        if len(missing) > 0:
+            rows[missing] = lookup_emb_store(store, variants, index=index)
+        gained = (rows[missing] >= 0).sum()
+        report.append('{} +{} ({:.2%})'.format(rule, gained, gained / len(rows)))
+    logger.info(' '.join(report))
+    return rows
+
+
+def fill_random_normal(out, mean, std, block=8192):
+    '''Same draws as np.random.normal(mean, std, out.shape), without the float64 copy of the whole matrix'''
+    for a in range(0, len(out), block):
+        out[a:a + block] = np.random.normal(mean, std, out[a:a + block].shape)
+    return out
+
+
+def _split_emb_line(line):
+    '''(word, values) of a `word v1 ... v300` line, words may contain spaces'''
+    line = line.rstrip()
+    n_spaces = line.count(b' ')
+    if n_spaces < emb_size:
+        return None, None
+    if n_spaces == emb_size:
+        word, _, values = line.partition(b' ')
+        return word, values
+    values = line.rsplit(b' ', emb_size)
+    return values[0], b' '.join(values[1:])
+
+
+def _chunk_ranges(path, n_chunks):
+    '''Split a file into byte ranges that start at line starts'''
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, n_chunks):
+            f.seek(size * k // n_chunks)
+            f.readline()
+            offsets.append(max(f.tell(), offsets[-1]))
+    offsets.append(size)
+    return [(a, b) for a, b in zip(offsets[:-1], offsets[1:]) if a < b]
+
+
+_worker_vocab = None
+
+
+def _init_emb_worker(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _parse_emb_chunk(args):
+    '''
+    Convert only the lines whose word is in the vocabulary, straight into the shared matrix.
+    with_stats: convert every line once to accumulate (count, mean, M2) of the file
+    '''
+    path, start, end, shm_name, shape, with_stats = args
+    shm = shared_memory.SharedMemory(name=shm_name)
+    matrix = np.ndarray(shape, dtype='float32', buffer=shm.buf)
+    found, block, stats = {}, [], (0, 0., 0.)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line: break  # noqa
+            word, values = _split_emb_line(line)
+            i = None if word is None else _worker_vocab.get(word.decode('utf-8', 'ignore'))
+            if i is not None or (with_stats and word is not None):
+                vector = np.array(values.split(), dtype='float32')
+                if i is not None:
+                    matrix[i] = vector
+                    found[i] = offset
+                if with_stats:
+                    block.append(vector)
+                    if len(block) == 4096:
+                        stats = _merge_stats(stats, _block_stats(np.stack(block)))
+                        block = []
+            offset += len(line)
+    if block:
+        stats = _merge_stats(stats, _block_stats(np.stack(block)))
+    del matrix
+    shm.close()
+    return found, stats
+
+
+def parse_emb_text(path, word_index, shape, stats=None, shm=None):
+    '''
+    Vocabulary-filtered parallel parser for text embedding files.
+    Byte ranges of the file are parsed by a process pool, workers write rows of word_index
+    directly into a preallocated float32 matrix in shared memory.
+    Without stats (emb_mean/emb_std) they are computed in the same pass.
+    With shm the matrix is left in that block, otherwise it is copied out.
+    Returns (embedding_matrix, (count, mean, M2) or None)
+    '''
+    t0 = time()
+    vocab = {word: i for word, i in word_index.items() if i < max_features}
+    own_shm = shm is None
+    if own_shm:
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+    try:
+        matrix = np.ndarray(shape, dtype='float32', buffer=shm.buf)
+        chunks = [(path, a, b, shm.name, shape, stats is None) for a, b in _chunk_ranges(path, n_jobs * 4)]
+        with Pool(n_jobs, initializer=_init_emb_worker, initargs=(vocab,)) as pool:
+            results = pool.map(_parse_emb_chunk, chunks)
+
+        # a word repeated across chunks: the last occurrence in the file wins
+        found, repeated, new_stats = {}, set(), (0, 0., 0.)
+        for chunk_found, chunk_stats in results:
+            repeated.update(found.keys() & chunk_found.keys())
+            found.update(chunk_found)
+            new_stats = _merge_stats(new_stats, chunk_stats)
+        if stats is None:
+            count, emb_mean, m2 = new_stats
+            emb_std = np.sqrt(m2 / count)
+        else:
+            emb_mean, emb_std = stats['mean'], stats['std']
+        missing = np.setdiff1d(np.arange(shape[0]), np.fromiter(found.keys(), dtype='int64'))
+        matrix[missing] = fill_random_normal(np.empty((len(missing), shape[1]), dtype='float32'), emb_mean, emb_std)
+        with open(path, 'rb') as f:
+            for i in repeated:
+                f.seek(found[i])
+                matrix[i] = np.array(_split_emb_line(f.readline())[1].split(), dtype='float32')
+        embedding_matrix = np.array(matrix) if own_shm else matrix
+        del matrix
+    finally:
+        if own_shm:
+            shm.close()
+            shm.unlink()
+    logger.info('Parsed {} ({}/{} words) in {:.2f}s'.format(
+        os.path.basename(path), len(found), len(vocab), time() - t0))
+    return embedding_matrix, None if stats is not None else new_stats
+
+
+def read_word2vec_bin(path, word_index, shape, stats=None, shm=None):
+    '''
+    Dependency-free reader for the word2vec .bin format (GoogleNews):
+    a `n_words dim` header line, then `word<space>` + dim little-endian float32 per word.
+    The file is memory-mapped, one scan builds the word -> offset index
+    and only the rows of word_index are converted.
+    Returns (embedding_matrix, (count, mean, M2) or None) like parse_emb_text
+    '''
+    t0 = time()
+    vocab = {word: i for word, i in word_index.items() if i < max_features}
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header_end = mm.find(b'\n') + 1
+    n_words, dim = map(int, mm[:header_end].split())
+    assert dim == shape[1], 'emb_size {} != {}'.format(shape[1], dim)
+    offsets = np.empty(n_words, dtype='int64')
+    found = {}
+    pos = header_end
+    for r in range(n_words):
+        end = mm.find(b' ', pos)
+        offsets[r] = end + 1
+        i = vocab.get(mm[pos:end].lstrip(b'\n').decode('utf-8', 'ignore'))
+        if i is not None:
+            found[i] = end + 1  # the last occurrence wins
+        pos = end + 1 + 4 * dim
+
+    data = np.frombuffer(mm, dtype=np.uint8)
+    columns = np.arange(4 * dim)
+    new_stats = None
+    if stats is None:
+        new_stats = (0, 0., 0.)
+        for a in range(0, n_words, 4096):
+            block = data[offsets[a:a + 4096, None] + columns].view('<f4')
+            new_stats = _merge_stats(new_stats, _block_stats(block))
+        count, emb_mean, m2 = new_stats
+        emb_std = np.sqrt(m2 / count)
     else:
-        raise NotImplementedError('No embedding: {}'.format(name))
-    logger.debug('Created embedding_index: {}'.format(name))
+        emb_mean, emb_std = stats['mean'], stats['std']
+    embedding_matrix = fill_random_normal(_new_matrix(shape, shm), emb_mean, emb_std)  # NOTE
+    indices = np.fromiter(found.keys(), dtype='int64', count=len(found))
+    rows = np.fromiter(found.values(), dtype='int64', count=len(found))
+    for a in range(0, len(rows), 4096):
+        embedding_matrix[indices[a:a + 4096]] = data[rows[a:a + 4096, None] + columns].view('<f4')
+    del data
+    mm.close()
+    logger.info('Read {} ({}/{} words) in {:.2f}s'.format(
+        os.path.basename(path), len(found), len(vocab), time() - t0))
+    return embedding_matrix, new_stats
+
+
+def _new_matrix(shape, shm=None):
+    if shm is None:
+        return np.empty(shape, dtype='float32')
+    return np.ndarray(shape, dtype='float32', buffer=shm.buf)
+
 
+def get_embedding(path, word_index, name='glove', shm=None):
+    if name.lower() not in ('glove', 'fasttext', 'paragram', 'google'):
+        raise NotImplementedError('No embedding: {}'.format(name))
     n_words = min(max_features, len(word_index))
-    embedding_matrix = np.random.normal(emb_mean, emb_std, (n_words + 1, emb_size))  # NOTE
-    for word, i in tqdm(word_index.items()):
-        if i >= max_features: continue  # noqa
-        embedding_vector = embeddings_index.get(word)
-        if embedding_vector is not None:
-            embedding_matrix[i] = embedding_vector
-
-    del embeddings_index, embedding_vector; gc.collect()  # noqa
+    shape = (n_words + 1, emb_size)
+
+    if name.lower() == 'google' or not emb_use_store:
+        parse = read_word2vec_bin if name.lower() == 'google' else parse_emb_text
+        embedding_matrix, new_stats = parse(path, word_index, shape, load_emb_stats(path, name), shm=shm)
+        if new_stats is not None:
+            save_emb_stats(path, name, new_stats)
+        return embedding_matrix
+
+    stats = load_emb_stats(path, name)
+    if stats is None or not emb_store_is_fresh(path, name):
+        build_emb_store(path, name)
+        stats = load_emb_stats(path, name)
+    embedding_matrix = fill_random_normal(_new_matrix(shape, shm), stats['mean'], stats['std'])  # NOTE
+    store = open_emb_store(name)
+    logger.debug('Opened embedding store: {}'.format(name))
+    words = [(word, i) for word, i in word_index.items() if i < max_features]
+    rows = lookup_emb_store(store, [word for word, _ in words])
+    if emb_oov_fallback:
+        rows = resolve_oov(store, [word for word, _ in words], rows, name=name)
+    indices = np.array([i for _, i in words], dtype='int64')
+    found = rows >= 0
+    # page in only the rows we need, in file order
+    order = np.argsort(rows[found])
+    embedding_matrix[indices[found][order]] = store['vectors'][rows[found][order]]
+    logger.debug('Found {}/{} words in {}'.format(found.sum(), len(words), name))
+    del store; gc.collect()  # noqa
     return embedding_matrix
 
 
+def _cache_key(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(json.dumps(part, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _vocab_digest(word_index):
+    h = hashlib.sha1()
+    for word, i in sorted(word_index.items(), key=lambda item: item[1]):
+        if i >= max_features: break  # noqa
+        h.update('{}\t{}\n'.format(word, i).encode('utf-8'))
+    return h.hexdigest()
+
+
+def cache_load(key):
+    if emb_cache_dir is None:
+        return None
+    path = os.path.join(emb_cache_dir, key + '.npy')
+    if not os.path.exists(path):
+        return None
+    os.utime(path)  # LRU: mtime is the last access
+    logger.info('Loaded cached embedding {}'.format(key))
+    return np.load(path)
+
+
+def cache_save(key, array):
+    if emb_cache_dir is None:
+        return
+    os.makedirs(emb_cache_dir, exist_ok=True)
+    path = os.path.join(emb_cache_dir, key + '.npy')
+    np.save(path + '.tmp.npy', array)
+    os.replace(path + '.tmp.npy', path)
+    entries = []
+    for f in os.listdir(emb_cache_dir):
+        try:
+            if not f.endswith('.tmp.npy'):
+                entries.append((os.path.getmtime(os.path.join(emb_cache_dir, f)), os.path.join(emb_cache_dir, f)))
+        except FileNotFoundError:
+            continue
+    entries = [entry for _, entry in sorted(entries)]
+    for old in entries[:max(len(entries) - emb_cache_size, 0)]:
+        try:
+            os.remove(old)
+        except FileNotFoundError:  # evicted by a concurrent loader
+            continue
+        logger.debug('Evicted cached embedding {}'.format(os.path.basename(old)))
+
+
+def fuse_embeddings(matrices, n_sources, method='mean', weights=None):
+    '''
+    Accumulate embedding matrices into a single float32 buffer in place.
+    matrices is an iterable consumed one source at a time, so only one source is alive at once.
+    method: 'mean', 'weighted' (mean with weights) or 'concat'
+    '''
+    if method == 'mean':
+        weights = [1.] * n_sources
+    elif method == 'weighted':
+        assert weights is not None and len(weights) == n_sources
+    elif method != 'concat':
+        raise NotImplementedError('No fusion: {}'.format(method))
+    fused = None
+    for k, matrix in enumerate(matrices):
+        n_words, dim = matrix.shape
+        if fused is None:
+            fused = np.zeros((n_words, dim * n_sources if method == 'concat' else dim), dtype='float32')
+        if method == 'concat':
+            fused[:, k * dim:(k + 1) * dim] = matrix
+        else:
+            for a in range(0, n_words, 8192):
+                fused[a:a + 8192] += np.float32(weights[k] / sum(weights)) * matrix[a:a + 8192]
+        del matrix
+        gc.collect()
+    return fused
+
+
+def _load_embedding(key, name, path, word_index, shm=None):
+    matrix = cache_load(key)
+    if matrix is None:
+        matrix = get_embedding(path, word_index, name=name, shm=shm)
+        cache_save(key, matrix)
+    elif shm is not None:
+        _new_matrix(matrix.shape, shm)[:] = matrix
+    return matrix
+
+
+def _load_embedding_worker(k, key, name, path, word_index, shm_name, worker_jobs):
+    global n_jobs
+    n_jobs = worker_jobs
+    np.random.seed(seed0 + k)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    matrix = _load_embedding(key, name, path, word_index, shm=shm)
+    del matrix
+    shm.close()
+
+
+def _estimate_load_memory(name, path, shape):
+    matrix_bytes = int(np.prod(shape)) * 4
+    if name.lower() == 'google':
+        return matrix_bytes + os.path.getsize(path) // 50  # word offsets, vectors are memory-mapped
+    if emb_use_store and emb_store_is_fresh(path, name):
+        return matrix_bytes
+    return matrix_bytes + os.path.getsize(path) // 4
+
+
+def load_embeddings_concurrent(sources, word_index, shape):
+    '''
+    Load (key, name, path) sources in parallel processes that write their matrices into shared memory.
+    A load starts only while the estimated memory of the loads in flight stays under emb_memory_limit.
+    Yields the matrices in source order, each block is freed once the caller moves on.
+    '''
+    worker_jobs = max(1, n_jobs // len(sources))
+    estimates = [_estimate_load_memory(name, path, shape) for _, name, path in sources]
+    running, next_k, matrix = {}, 0, None
+    try:
+        for k in range(len(sources)):
+            while next_k < len(sources) and (
+                    not running or sum(running[j][2] for j in running) + estimates[next_k] <= emb_memory_limit):
+                key, name, path = sources[next_k]
+                shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+                process = Process(
+                    target=_load_embedding_worker,
+                    args=(next_k, key, name, path, word_index, shm.name, worker_jobs))
+                process.start()
+                running[next_k] = (process, shm, estimates[next_k])
+                logger.info('Started loading {} ({:.1f}GB estimated)'.format(name, estimates[next_k] / 2 ** 30))
+                next_k += 1
+            process, shm, _ = running[k]
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError('Failed to load embedding: {}'.format(sources[k][1]))
+            matrix = _new_matrix(shape, shm)
+            yield matrix
+            matrix = None
+            del running[k]
+            shm.close()
+            shm.unlink()
+    finally:
+        matrix = None
+        for process, shm, _ in running.values():
+            process.terminate()
+            process.join()
+            shm.close()
+            shm.unlink()
+
+
+def load_embeddings(emb_paths, word_index):
+    '''
+    Fusion (emb_fusion) of get_embedding over emb_paths, cached on disk by a hash of
+    the embedding files, the vocabulary and max_features
+    '''
+    vocab = _vocab_digest(word_index)
+    # the OOV fallback only runs on the store path, key on whether it ran for each source
+    keys = [
+        _cache_key(
+            name, _file_identity(path), vocab, max_features, emb_size,
+            emb_oov_fallback and emb_use_store and name.lower() != 'google')
+        for name, path in emb_paths.items()]
+    weights = None if emb_weights is None else [emb_weights[name] for name in emb_paths]
+    key = _cache_key(emb_fusion, weights, keys)
+    embedding = cache_load(key)
+    if embedding is not None:
+        return embedding
+
+    sources = [(key_i, name, path) for key_i, (name, path) in zip(keys, emb_paths.items())]
+
+    def load_sequential():
+        for key_i, name, path in sources:
+            matrix = _load_embedding(key_i, name, path, word_index)
+            yield matrix
+            del matrix
+
+    if emb_concurrent and len(sources) > 1:
+        shape = (min(max_features, len(word_index)) + 1, emb_size)
+        matrices = load_embeddings_concurrent(sources, word_index, shape)
+    else:
+        matrices = load_sequential()
+    embedding = fuse_embeddings(matrices, len(emb_paths), method=emb_fusion, weights=weights)
+    cache_save(key, embedding)
+    return embedding
+
+
 def f1_score_for_thresholds(y_true, proba):
     best_score, best_thresh = 0., 0.
     for thresh in thresholds:
@@ -299,7 +1567,7 @@ def validate(model, data_loader, criterion, device):
             outputs += out.detach().cpu().numpy().tolist()
             trues += targets.detach().numpy().tolist()
     f1, thresh = f1_score_for_thresholds(trues, outputs)
-    return {'loss': losses.avg, 'f1': f1, 'thresh': thresh, 'output': np.array(outputs).flatten()}
+    return {'loss': losses.avg, 'f1': f1, 'thresh': thresh, 'output': unsort(np.array(outputs).flatten(), data_loader)}
 
 
 def test(model, data_loader, device):
@@ -311,51 +1579,224 @@ def test(model, data_loader, device):
             out = model(inputs)
             out = torch.sigmoid(out)
             outputs += out.detach().cpu().numpy().tolist()
-    return np.array(outputs).flatten()
+    return unsort(np.array(outputs).flatten(), data_loader)
 
 
-def main():
-    # data
-    df_train = pd.read_csv('../input/train.csv')
-    df_test = pd.read_csv('../input/test.csv')
-    # preprocess
-    t0 = time()
-    df_train = preprocess(df_train)
-    df_test = preprocess(df_test)
-    X_train = df_train['question_text'].fillna('_na_').values
-    X_test = df_test['question_text'].fillna('_na_').values
-    logger.info('Preprocessed in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
-    # features
-    # tokenize
+def bench_embedding(embedding, n_batches=100):
+    '''Lookup speed, size and error of QuantizedEmbedding against the float32 nn.Embedding'''
+    weight = torch.as_tensor(embedding, dtype=torch.float32)
+    batches = torch.randint(0, len(weight), (n_batches, batch_size, maxlen)).to(device)
+    for dtype in ['float32', 'float16', 'int8']:
+        if dtype == 'float32':
+            layer = nn.Embedding.from_pretrained(weight)
+        else:
+            layer = QuantizedEmbedding(weight, dtype)
+        layer = layer.to(device)
+        size = sum(t.numel() * t.element_size() for t in list(layer.parameters()) + list(layer.buffers()))
+        with torch.no_grad():
+            t0 = time()
+            for x in batches:
+                layer(x)
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            elapsed = time() - t0
+            error = (layer(torch.arange(len(weight), device=device)).cpu() - weight).abs().max().item()
+        logger.info('Bench embedding {} {:.1f}MB {:.3f}ms/batch max abs error {:.5f}'.format(
+            dtype, size / 2 ** 20, elapsed / n_batches * 1000, error))
+        del layer
+
+
+def bench_embedding_f1(X, lengths, y, embedding, n_samples=100000):
+    '''
+    Validation F1 of RNNAttn trained with the frozen embedding stored as each dtype, on one stratified holdout
+    of n_samples questions as large as a fold, with the epochs and the unfreeze schedule of main()
+    '''
+    indices = np.random.permutation(len(y))[:n_samples]
+    train_idx, val_idx = train_test_split(indices, test_size=1 / n_splits, stratify=y[indices], random_state=seed0)
+    train_loader = make_loader(
+        X, lengths, torch.from_numpy(y[train_idx].astype('float32')), indices=train_idx, shuffle=True,
+        ragged=ragged, bucket_batches=bucket_batches)
+    val_loader = make_loader(
+        X, lengths, torch.from_numpy(y[val_idx].astype('float32')), indices=val_idx,
+        ragged=ragged, bucket_batches=bucket_batches)
+    criterion = nn.BCEWithLogitsLoss()
+    weights = None
+    for dtype in ['float32', 'float16', 'int8']:
+        model = RNNAttn(
+            max_features, embedding_size=embedding.shape[1], embedding=embedding,
+            embedding_trainable=embedding_trainable, embedding_dtype=dtype, rnn=rnn, packed=packed,
+            device=device).to(device)
+        # same initial layers and batches for every dtype, only the embedding storage differs
+        if weights is None:
+            weights = {name: w.clone() for name, w in model.state_dict().items() if not name.startswith('embedding.')}
+        model.load_state_dict(weights, strict=False)
+        set_seed(seed0)
+        optimizer = optim.Adam(model.parameters(), lr=lr)
+        for epoch_i in range(1, 1 + epochs):
+            if epoch_unfreeze is not None and epoch_i == epoch_unfreeze:
+                unfreeze(model)
+                optimizer = optim.Adam(model.parameters(), lr=lr2)
+            train(model, train_loader, criterion, optimizer, device)
+        validation = validate(model, val_loader, criterion, device)
+        logger.info('Bench embedding {} Val/F1 {:.4f} Threshold {:.2f}'.format(
+            dtype, validation['f1'], validation['thresh']))
+        del model, optimizer
+
+
+def bench_pooling_head(n_batches=100, hidden_size=128):
+    '''
+    AttentionPooling with and without a mask over the same hidden states,
+    on a batch without padding the masked head must give bit-identical outputs
+    '''
+    head = AttentionPooling(hidden_size, maxlen).to(device)
+    x = torch.randn(batch_size, maxlen, hidden_size, device=device)
+    lengths = torch.randint(1, maxlen + 1, (batch_size,), device=device)
+    mask = torch.arange(maxlen, device=device) >= (maxlen - lengths).unsqueeze(1)
+
+    with torch.no_grad():
+        for name, m in [('masked', mask), ('unmasked', None)]:
+            t0 = time()
+            for _ in range(n_batches):
+                head(x, m)
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            logger.info('Bench pooling head {} {:.3f}ms/batch'.format(name, (time() - t0) / n_batches * 1000))
+        equal = [torch.equal(p, q) for p, q in zip(head(x, torch.ones_like(mask)), head(x))]
+    logger.info('Bench pooling head masked == unmasked without padding (attn, avg, max): {}'.format(equal))
+    assert all(equal), 'masked pooling head differs from the unmasked one on a batch without padding'
+
+
+def bench_text_function(texts, fn, reference):
+    '''Throughput of fn against reference on texts, the outputs must be identical'''
     t0 = time()
-    tokenizer = Tokenizer(lower=True, filters='', num_words=max_features)  # NOTE
-    tokenizer.fit_on_texts(list(X_train))  # NOTE + list(X_test))
-    X_train = tokenizer.texts_to_sequences(X_train)
-    X_test = tokenizer.texts_to_sequences(X_test)
-    logger.info('Tokenized in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
-    # padding
+    expected = [reference(text) for text in texts]
+    time_reference = time() - t0
     t0 = time()
-    X_train = pad_sequences(X_train, maxlen=maxlen)
-    X_test = pad_sequences(X_test, maxlen=maxlen)
-    logger.info('Padding in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
-    # target
-    y_train = df_train['target'].values
+    outputs = [fn(text) for text in texts]
+    time_fn = time() - t0
+    assert outputs == expected, '{} differs from {}'.format(fn.__name__, reference.__name__)
+    logger.info('Bench {} {:.0f} texts/s {} {:.0f} texts/s ({:.1f}x)'.format(
+        fn.__name__, len(texts) / time_fn, reference.__name__, len(texts) / time_reference,
+        time_reference / time_fn))
+
+
+def bench_normalise_memo(texts):
+    '''Speedup and hit rate of the token memo against the string-level normalise'''
+    _normalise_token.cache_clear()
+    bench_text_function(texts, normalise_memo, normalise)
+    info = _normalise_token.cache_info()
+    logger.info('Bench normalise_memo hit rate {:.2%} ({} distinct tokens)'.format(
+        info.hits / max(info.hits + info.misses, 1), info.currsize))
+
+
+def bench_preprocess(texts):
+    '''Scaling of preprocess_texts with the number of workers'''
+    n_workers, elapsed = 1, {}
+    while n_workers <= n_jobs:
+        t0 = time()
+        preprocess_texts(texts, n_workers=n_workers)
+        elapsed[n_workers] = time() - t0
+        logger.info('Bench preprocess {} workers {:.2f}s speedup {:.2f}x'.format(
+            n_workers, elapsed[n_workers], elapsed[1] / elapsed[n_workers]))
+        n_workers *= 2
+
+
+def bench_bucketing(X, lengths, y, embedding, n_samples=50000):
+    '''Training throughput of length-bucketed batches trimmed to their longest question against maxlen batches'''
+    indices = np.random.permutation(len(y))[:n_samples]
+    targets = torch.from_numpy(y[indices].astype('float32'))
+    for bucketing in [False, True]:
+        loader = make_loader(
+            X, lengths, targets, indices=indices, shuffle=True, ragged=ragged, bucket_batches=bucketing)
+        steps = np.mean([inputs.size(1) for inputs, _ in loader])
+        model = RNNAttn(
+            max_features, embedding_size=emb_size if embedding is None else embedding.shape[1], embedding=embedding,
+            embedding_trainable=embedding_trainable, embedding_dtype=emb_dtype, rnn=rnn, packed=packed,
+            device=device).to(device)
+        optimizer = optim.Adam(model.parameters(), lr=lr)
+        t0 = time()
+        train(model, loader, nn.BCEWithLogitsLoss(), optimizer, device)
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        logger.info('Bench bucket_batches {} {:.0f} samples/s {:.1f} steps/batch'.format(
+            bucketing, len(indices) / (time() - t0), steps))
+        del model, optimizer
+
+
+def main():
+    # data
+    if csv_chunksize is not None:
+        t0 = time()
+        tokenizer = Tokenizer(lower=True, filters='', num_words=max_features)  # NOTE
+        with Pool(n_jobs) as pool:
+            n_train = fit_tokenizer_streaming('../input/train.csv', tokenizer, pool=pool)
+            X_train, lengths_train, y_train = encode_streaming(
+                '../input/train.csv', tokenizer, n_train, pool=pool, target=True)
+            X_test, lengths_test, _ = encode_streaming('../input/test.csv', tokenizer, pool=pool)
+        logger.info('Streamed data in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
+    else:
+        df_train = pd.read_csv('../input/train.csv')
+        df_test = pd.read_csv('../input/test.csv')
+        # preprocess
+        if benchmark:
+            texts = df_train['question_text'].str.lower().tolist()
+            bench_text_function(texts, clean_punctuation, clean_punctuation_replace)
+            for df in [df_train, df_test]:
+                bench_text_function(df['question_text'].tolist(), clean_number, clean_number_sub)
+            bench_preprocess(df_train['question_text'].tolist())
+            bench_normalise_memo(df_train['question_text'].tolist())
+        t0 = time()
+        df_train = preprocess(df_train)
+        df_test = preprocess(df_test)
+        X_train = df_train['question_text'].fillna('_na_').values
+        X_test = df_test['question_text'].fillna('_na_').values
+        logger.info('Preprocessed in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
+        # features
+        # tokenize
+        t0 = time()
+        tokenizer = Tokenizer(lower=True, filters='', num_words=max_features)  # NOTE
+        tokenizer.fit_on_texts(list(X_train))  # NOTE + list(X_test))
+        X_train = tokenizer.texts_to_ragged(X_train)
+        X_test = tokenizer.texts_to_ragged(X_test)
+        logger.info('Tokenized in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
+        # padding
+        t0 = time()
+        if ragged:
+            X_train, X_test = RaggedTokens(*X_train), RaggedTokens(*X_test)
+            lengths_train, lengths_test = X_train.lengths, X_test.lengths
+        else:
+            X_train, lengths_train = pad_ragged(*X_train, maxlen=maxlen)
+            X_test, lengths_test = pad_ragged(*X_test, maxlen=maxlen)
+        logger.info('Padding in {:.2f}s. Time {:.2f}s'.format(time() - t0, time() - start_time))
+        # target
+        y_train = df_train['target'].values
+    if ragged and ragged_dir is not None:
+        # map the ids back from disk, the embedding loading below then does not hold them in memory too
+        os.makedirs(ragged_dir, exist_ok=True)
+        X_train.save(os.path.join(ragged_dir, 'X_train'))
+        X_test.save(os.path.join(ragged_dir, 'X_test'))
+        X_train = RaggedTokens.load(os.path.join(ragged_dir, 'X_train'))
+        X_test = RaggedTokens.load(os.path.join(ragged_dir, 'X_test'))
 
     # embedding
     if debug:
         embedding = None
     else:
-        embeddings = []
-        for name, path in emb_paths.items():
-            embeddings.append(get_embedding(path, tokenizer.word_index, name=name))
-        embedding = np.mean(embeddings, axis=0)
-        del embeddings
-        gc.collect()
+        embedding = load_embeddings(emb_paths, tokenizer.word_index)
     logger.info('Loaded embeddings. Time {:.2f}s'.format(time() - start_time))
+    if benchmark and embedding is not None:
+        bench_embedding(embedding)
 
     # data loader
-    test_dataset = TensorDataset(torch.from_numpy(X_test.astype('int64')))
-    test_loader = DataLoader(test_dataset, batch_size, shuffle=False)
+    if ragged:
+        logger.info('Ragged tokens {:.1f}MB, padded {:.1f}MB'.format(
+            (X_train.nbytes + X_test.nbytes) / 2 ** 20, (len(X_train) + len(X_test)) * maxlen * 4 / 2 ** 20))
+    test_loader = make_loader(X_test, lengths_test, ragged=ragged, bucket_batches=bucket_batches)
+    if benchmark:
+        bench_bucketing(X_train, lengths_train, y_train, embedding)
+        bench_pooling_head()
+        if embedding is not None:
+            bench_embedding_f1(X_train, lengths_train, y_train, embedding)
 
     # train
     seed = set_seed(seed0)
@@ -365,19 +1806,21 @@ def main():
     for fold_i, (train_idx, val_idx) in enumerate(skf.split(X_train, y_train)):
         logger.info('Fold {}'.format(fold_i + 1))
         # split
-        X_train_fold, y_train_fold = X_train[train_idx].astype('int64'), y_train[train_idx].astype('float32')
-        X_val_fold, y_val_fold = X_train[val_idx].astype('int64'), y_train[val_idx].astype('float32')
-        train_dataset = TensorDataset(torch.from_numpy(X_train_fold), torch.from_numpy(y_train_fold))
-        val_dataset = TensorDataset(torch.from_numpy(X_val_fold), torch.from_numpy(y_val_fold))
+        y_train_fold, y_val_fold = y_train[train_idx].astype('float32'), y_train[val_idx].astype('float32')
         # data loader
-        train_loader  = DataLoader(train_dataset, batch_size=batch_size, shuffle=True)
-        val_loader = DataLoader(val_dataset, batch_size, shuffle=False)
+        train_loader = make_loader(
+            X_train, lengths_train, torch.from_numpy(y_train_fold), indices=train_idx, shuffle=True,
+            ragged=ragged, bucket_batches=bucket_batches)
+        val_loader = make_loader(
+            X_train, lengths_train, torch.from_numpy(y_val_fold), indices=val_idx,
+            ragged=ragged, bucket_batches=bucket_batches)
 
         set_seed(seed + fold_i)
         # model
         model = RNNAttn(
-            max_features, embedding_size=emb_size, embedding=embedding,
-            embedding_trainable=embedding_trainable, device=device).to(device)
+            max_features, embedding_size=emb_size if embedding is None else embedding.shape[1], embedding=embedding,
+            embedding_trainable=embedding_trainable, embedding_dtype=emb_dtype, rnn=rnn, packed=packed,
+            device=device).to(device)
         criterion = nn.BCEWithLogitsLoss()
         optimizer = optim.Adam(model.parameters(), lr=lr)
 
@@ -385,8 +1828,7 @@ def main():
             if debug: break
             message = ''
             if epoch_unfreeze is not None and epoch_i == epoch_unfreeze:
-                for param in model.parameters():
-                    param.requires_grad = True
+                unfreeze(model)
                 optimizer = optim.Adam(model.parameters(), lr=lr2)
                 message = 'Unfreezed. LR {}'.format(lr2)
             loss = train(model, train_loader, criterion, optimizer, device)
@@ -411,7 +1853,7 @@ def main():
 
     # submit
     f1, threshold = f1_score_for_thresholds(y_train, proba_train)
-    logger.info('Train/F1/Best {:.4f} Threshold {:.2f}'.format(f1, threshold))
+    logger.info('Train/F1/Best {:.4f} Threshold {:.2f} Embedding {} RNN {}'.format(f1, threshold, emb_dtype, rnn))
 
     y_pred = (proba_test.mean(axis=1) > threshold).astype('int')
     submit = pd.read_csv('../input/sample_submission.csv')